@@ -7,7 +7,6 @@ CACHEDIR = pathlib.Path(CACHEHOME) / "metapkg"
 
 
 def cachedir() -> pathlib.Path:
-    if not CACHEDIR.exists():
-        CACHEDIR.mkdir(parents=True)
+    CACHEDIR.mkdir(parents=True, exist_ok=True)
 
     return CACHEDIR
@@ -1,30 +1,61 @@
 from __future__ import annotations
-from typing import cast
+from typing import TYPE_CHECKING, Iterable
 
 import collections
-import datetime
-import graphlib
-import importlib
+import functools
+import itertools
 import os
 import pathlib
+import re
 import sys
-import tempfile
 
 from cleo.helpers import argument, option
 
-from poetry import puzzle
-from poetry.core.packages import dependency as poetry_dep
-from poetry.core.packages import project_package
-from poetry.repositories import repository_pool as poetry_repository_pool
-from poetry.utils import env as poetry_env
+if sys.platform != "win32":
+    import resource
 
-from metapkg import targets
-from metapkg.packages import base as mpkg_base
-from metapkg.packages import python as af_python
-from metapkg.packages import repository as af_repo
+try:
+    import graphlib2 as graphlib
+except ImportError:
+    import graphlib  # type: ignore[no-redef]
 
 from . import base
 
+if TYPE_CHECKING:
+    from poetry.core.constraints import version as poetry_version
+    from poetry.core.version import markers as poetry_markers
+    from poetry.utils import env as poetry_env
+
+    from metapkg import targets
+    from metapkg.packages import base as mpkg_base
+    from metapkg.packages import repository as af_repo
+
+
+# One match per comma-separated "key=value" pair, with both parts
+# stripped of surrounding whitespace; a missing value matches as "".
+_TAG_RE = re.compile(r"(?:^|,)\s*([^,=]*?)\s*(?:=\s*([^,]*?)\s*)?(?=,|\Z)")
+
+
+@functools.cache
+def _load_package_class(pkgname: str) -> type[mpkg_base.BundledPackage]:
+    import importlib
+
+    from metapkg.packages import base as mpkg_base
+
+    modname, _, clsname = pkgname.rpartition(":")
+
+    mod = importlib.import_module(modname)
+    pkgcls: type[mpkg_base.BundledPackage] = getattr(mod, clsname)
+    assert issubclass(pkgcls, mpkg_base.BundledPackage)
+    return pkgcls
+
+
+@functools.cache
+def _system_env() -> poetry_env.SystemEnv:
+    from poetry.utils import env as poetry_env
+
+    return poetry_env.SystemEnv(pathlib.Path(sys.executable))
+
 
 class Build(base.Command):
     name = "build"
@@ -123,6 +154,15 @@ class Build(base.Command):
     _loggers = ["metapkg.build"]
 
     def handle(self) -> int:
+        # Poetry and the target machinery are expensive to import,
+        # so only pull them in when the command actually runs.
+        import datetime
+        import tempfile
+
+        from poetry.core.packages import dependency as poetry_dep
+
+        from metapkg import targets
+
         pkgname = self.argument("name")
         keepwork = self.option("keepwork")
         destination = self.option("dest")
@@ -155,19 +195,13 @@ class Build(base.Command):
 
         tags = {}
         if tags_string:
-            for pair in tags_string.split(","):
-                k, _, v = pair.strip().partition("=")
-                tags[k.strip()] = v.strip()
+            tags = dict(_TAG_RE.findall(tags_string))
 
         compression = []
         if compression_string:
             compression = compression_string.split(",")
 
-        modname, _, clsname = pkgname.rpartition(":")
-
-        mod = importlib.import_module(modname)
-        pkgcls = getattr(mod, clsname)
-        assert issubclass(pkgcls, mpkg_base.BundledPackage)
+        pkgcls = _load_package_class(pkgname)
         root_pkg = pkgcls.resolve(
             self.io,
             version=version,
@@ -178,27 +212,35 @@ class Build(base.Command):
         if tags:
             root_pkg.set_metadata_tags(tags)
 
-        env = poetry_env.SystemEnv(pathlib.Path(sys.executable))
-        packages, build_pkgs = self._resolve_deps(env, target, root_pkg, [])
+        env = _system_env()
+        # The same repositories serve both resolution passes as well
+        # as any re-resolution below, so set them up only once.
+        repo_pool = self._build_repo_pool(target, root_pkg)
+        packages, build_pkgs = self._resolve_deps(
+            env, target, repo_pool, root_pkg, []
+        )
 
         # Build dependency resolution could have changed the
         # installable dependency list, so we might need to re-run
-        # the non-build-deps resolution.
-        reresolve_deps = self._check_dep_consistency(packages, build_pkgs)
-        if reresolve_deps:
-            packages, build_pkgs = self._resolve_deps(
-                env, target, root_pkg, reresolve_deps
-            )
+        # the non-build-deps resolution, but only once.
+        for attempt in range(2):
+            reresolve_deps = self._check_dep_consistency(packages, build_pkgs)
+            if not reresolve_deps:
+                break
+            elif attempt == 1:
+                self.io.write_error_line(
+                    "Unresolveable install-time vs build-time dependency "
+                    + "graph. Mismatching dependencies: "
+                    + ", ".join(
+                        poetry_dep.Dependency(name, version).to_pep_508()
+                        for name, version in reresolve_deps
+                    )
+                )
+                return 1
 
-        # Check again
-        reresolve_deps = self._check_dep_consistency(packages, build_pkgs)
-        if reresolve_deps:
-            self.io.write_error_line(
-                "Unresolveable install-time vs build-time dependency graph. "
-                + "Mismatching dependencies: "
-                + ", ".join(dep.to_pep_508() for dep in reresolve_deps)
+            packages, build_pkgs = self._resolve_deps(
+                env, target, repo_pool, root_pkg, reresolve_deps
             )
-            return 1
 
         tempdir: tempfile.TemporaryDirectory[str] | None = None
         if keepwork:
@@ -239,21 +281,58 @@ class Build(base.Command):
 
         return 0
 
+    def _build_repo_pool(
+        self,
+        target: targets.Target,
+        root_pkg: mpkg_base.BundledPackage,
+    ) -> af_repo.Pool:
+        from poetry.repositories import repository_pool as poetry_repo_pool
+
+        from metapkg.packages import repository as af_repo
+
+        repo_pool = af_repo.Pool()
+        repo_pool.add_repository(target.get_package_repository())
+        repo_pool.add_repository(
+            af_repo.bundle_repo,
+            priority=poetry_repo_pool.Priority.SUPPLEMENTAL,
+        )
+
+        item_repo = root_pkg.get_package_repository(target, io=self.io)
+        if item_repo is not af_repo.bundle_repo:
+            repo_pool.add_repository(
+                item_repo,
+                priority=poetry_repo_pool.Priority.SUPPLEMENTAL,
+            )
+
+        return repo_pool
+
     def _resolve_deps(
         self,
         env: poetry_env.Env,
         target: targets.Target,
+        repo_pool: af_repo.Pool,
         root_pkg: mpkg_base.BundledPackage,
-        extra_deps: list[poetry_dep.Dependency] | None = None,
+        pinned_versions: (
+            list[tuple[mpkg_base.NormalizedName, poetry_version.Version]]
+            | None
+        ) = None,
     ) -> tuple[list[mpkg_base.BasePackage], list[mpkg_base.BasePackage]]:
+        from poetry import puzzle
+        from poetry.core.packages import dependency as poetry_dep
+        from poetry.core.packages import project_package
+
+        from metapkg.packages import base as mpkg_base
+        from metapkg.packages import python as af_python
+        from metapkg.packages import repository as af_repo
+
         root = project_package.ProjectPackage("__root__", "1")
         root.python_versions = af_python.python_dependency.pretty_constraint
         root.add_dependency(
             poetry_dep.Dependency(root_pkg.name, root_pkg.version)
         )
-        if extra_deps is not None:
-            for extra_dep in extra_deps:
-                root.add_dependency(extra_dep)
+        if pinned_versions is not None:
+            for name, version in pinned_versions:
+                root.add_dependency(poetry_dep.Dependency(name, version))
         af_repo.bundle_repo.add_package(root)
 
         target_capabilities = target.get_capabilities()
@@ -261,39 +340,36 @@ class Build(base.Command):
             root_pkg.features
         )
 
-        repo_pool = af_repo.Pool()
-        repo_pool.add_repository(target.get_package_repository())
-        repo_pool.add_repository(
-            af_repo.bundle_repo,
-            priority=poetry_repository_pool.Priority.SUPPLEMENTAL,
-        )
-
-        item_repo = root_pkg.get_package_repository(target, io=self.io)
-        if item_repo is not af_repo.bundle_repo:
-            repo_pool.add_repository(
-                item_repo,
-                priority=poetry_repository_pool.Priority.SUPPLEMENTAL,
-            )
-
         provider = af_repo.Provider(root, repo_pool, self.io, extras=extras)
         solver = puzzle.Solver(root, repo_pool, [], [], self.io)
         solver._provider = provider
-        resolution = solver._solve()
+        # All candidate packages come from metapkg repositories.
+        resolution: Iterable[mpkg_base.BasePackage]
+        resolution = solver._solve()  # type: ignore[assignment]
+
+        # The same marker objects are shared by many requirements
+        # across the bundle, so only evaluate each of them once.
+        marker_cache: dict[int, bool] = {}
+        env_is_valid_for_marker = env.is_valid_for_marker
+
+        def is_valid_for_marker(marker: poetry_markers.BaseMarker) -> bool:
+            key = id(marker)
+            valid = marker_cache.get(key)
+            if valid is None:
+                valid = marker_cache[key] = env_is_valid_for_marker(marker)
+            return valid
 
         pkg_map: dict[mpkg_base.NormalizedName, mpkg_base.BasePackage] = {}
+        graph: dict[mpkg_base.NormalizedName, set[mpkg_base.NormalizedName]]
         graph = {}
         for dep_package in resolution:
-            pkg_map[dep_package.name] = cast(
-                mpkg_base.BasePackage, dep_package
-            )
-            deps = {
-                req.name
-                for req in dep_package.requires
-                if env.is_valid_for_marker(req.marker)
-            }
-            graph[dep_package.name] = deps
+            pkg_map[dep_package.name] = dep_package
+            deps = graph[dep_package.name] = set()
+            for req in dep_package.requires:
+                if is_valid_for_marker(req.marker):
+                    deps.add(req.name)
         sorter = graphlib.TopologicalSorter(graph)
-        packages = [pkg_map[pn] for pn in sorter.static_order()]
+        packages = list(map(pkg_map.__getitem__, sorter.static_order()))
 
         af_repo.bundle_repo.remove_package(root)
 
@@ -316,29 +392,67 @@ class Build(base.Command):
         solver._provider = provider
         mpkg_base.all_requires_include_build_reqs = True
         try:
-            resolution = solver._solve()
+            resolution = solver._solve()  # type: ignore[assignment]
         finally:
             mpkg_base.all_requires_include_build_reqs = False
 
+        breqs_by_pkg = {
+            dep_package: mpkg_base.get_build_requirements(dep_package)
+            for dep_package in resolution
+        }
+
         pkg_map = {}
         graph = {}
         for dep_package in resolution:
-            pkg_map[dep_package.name] = cast(
-                mpkg_base.BasePackage, dep_package
-            )
-            breqs = mpkg_base.get_build_requirements(dep_package)
-            deps = {
-                req.name
-                for req in set(dep_package.requires) | set(breqs)
+            pkg_map[dep_package.name] = dep_package
+            own_name = dep_package.name
+            deps = graph[own_name] = set()
+            for req in itertools.chain(
+                dep_package.requires, breqs_by_pkg[dep_package]
+            ):
                 if (
-                    req.is_activated()
-                    and env.is_valid_for_marker(req.marker)
+                    req.name not in deps
                     # Poetry inserts package dependency on itself
                     # for dependencies with extras.
-                    and req.name != dep_package.name
-                )
-            }
-            graph[dep_package.name] = deps
+                    and req.name != own_name
+                    and req.is_activated()
+                    and is_valid_for_marker(req.marker)
+                ):
+                    deps.add(req.name)
+
+        build_pkgs, cyclic_edges = self._sort_build_deps(graph, pkg_map)
+
+        cyclic_runtime_deps: dict[
+            mpkg_base.BasePackage, list[mpkg_base.BasePackage]
+        ] = {}
+        for pkg_with_dep, dep in cyclic_edges:
+            cyclic_runtime_deps.setdefault(pkg_with_dep, []).append(dep)
+
+        # Splice cyclic deps in right after the packages depending on them.
+        # Going from the back keeps the indexes of earlier packages valid.
+        build_pkg_index = {pkg: i for i, pkg in enumerate(build_pkgs)}
+        insertions = sorted(
+            (
+                (build_pkg_index[pkg_with_cr_deps], cr_deps)
+                for pkg_with_cr_deps, cr_deps in cyclic_runtime_deps.items()
+            ),
+            key=lambda ins: ins[0],
+            reverse=True,
+        )
+        for i, cr_deps in insertions:
+            build_pkgs[i + 1 : i + 1] = cr_deps
+
+        return packages, build_pkgs
+
+    def _sort_build_deps(
+        self,
+        graph: dict[mpkg_base.NormalizedName, set[mpkg_base.NormalizedName]],
+        pkg_map: dict[mpkg_base.NormalizedName, mpkg_base.BasePackage],
+    ) -> tuple[
+        list[mpkg_base.BasePackage],
+        list[tuple[mpkg_base.BasePackage, mpkg_base.BasePackage]],
+    ]:
+        from metapkg.packages import python as af_python
 
         # Workaround cycles in build/runtime dependencies between
         # packages.  This requires the depending package to explicitly
@@ -347,73 +461,111 @@ class Build(base.Command):
         # into the dependent's context to build itself (e.g. by manipulating
         # PYTHONPATH at build time.)  An example of such cycle is
         # flit-core -> tomli -> flit-core.
-        cyclic_runtime_deps = collections.defaultdict(list)
-        last_cycle = None
-        current_cycle = None
-        while True:
-            sorter = graphlib.TopologicalSorter(graph)
+        #
+        # This is Kahn's algorithm: whenever it stalls with nodes left
+        # over, the remainder contains a cycle, so break one of its edges
+        # and carry on with the sort instead of starting over.
+        cyclic_edges: list[
+            tuple[mpkg_base.BasePackage, mpkg_base.BasePackage]
+        ] = []
+
+        indegree: dict[mpkg_base.NormalizedName, int] = {}
+        dependents: dict[
+            mpkg_base.NormalizedName, list[mpkg_base.NormalizedName]
+        ] = collections.defaultdict(list)
+        for name, deps in graph.items():
+            indegree[name] = len(deps)
+            for dep_name in deps:
+                indegree.setdefault(dep_name, 0)
+                dependents[dep_name].append(name)
+
+        cyclic_deps_cache: dict[mpkg_base.BasePackage, frozenset[str]] = {}
+
+        def allows_cyclic_dep(
+            pkg: mpkg_base.BasePackage,
+            dep: mpkg_base.BasePackage,
+        ) -> bool:
+            if not isinstance(pkg, af_python.PythonPackage):
+                return True
+            cyclic_deps = cyclic_deps_cache.get(pkg)
+            if cyclic_deps is None:
+                cyclic_deps = pkg.get_cyclic_runtime_deps()
+                cyclic_deps_cache[pkg] = cyclic_deps
+            return dep.name in cyclic_deps
+
+        ready = collections.deque(n for n, d in indegree.items() if d == 0)
+        build_pkgs: list[mpkg_base.BasePackage] = []
 
-            try:
-                build_pkgs = [pkg_map[pn] for pn in sorter.static_order()]
-            except graphlib.CycleError as e:
-                cycle = e.args[1]
-                if len(cycle) > 3 or cycle == last_cycle:
-                    raise
-
-                dep = pkg_map[cycle[-1]]
-                pkg_with_dep = pkg_map[cycle[-2]]
-                if (
-                    isinstance(pkg_with_dep, af_python.PythonPackage)
-                    and dep.name not in pkg_with_dep.get_cyclic_runtime_deps()
-                ):
-                    dep, pkg_with_dep = pkg_with_dep, dep
-                    if (
-                        isinstance(pkg_with_dep, af_python.PythonPackage)
-                        and dep.name
-                        not in pkg_with_dep.get_cyclic_runtime_deps()
-                    ):
-                        raise
-
-                last_cycle = current_cycle
-                current_cycle = cycle
-                cyclic_runtime_deps[pkg_with_dep].append(dep)
-                graph[pkg_with_dep.name].remove(dep.name)
-            else:
+        while True:
+            while ready:
+                name = ready.popleft()
+                build_pkgs.append(pkg_map[name])
+                for dependent in dependents.get(name, ()):
+                    indegree[dependent] -= 1
+                    if indegree[dependent] == 0:
+                        ready.append(dependent)
+
+            if len(build_pkgs) == len(indegree):
                 break
 
-        for pkg_with_cr_deps, cr_deps in cyclic_runtime_deps.items():
-            for i, build_pkg in enumerate(build_pkgs):
-                if build_pkg == pkg_with_cr_deps:
-                    build_pkgs[i + 1 : i + 1] = cr_deps
-                    break
+            cycle = self._find_cycle(graph, indegree)
+            if len(cycle) > 3:
+                raise graphlib.CycleError("nodes are in a cycle", cycle)
 
-        return packages, build_pkgs
+            dep = pkg_map[cycle[-1]]
+            pkg_with_dep = pkg_map[cycle[-2]]
+            if not allows_cyclic_dep(pkg_with_dep, dep):
+                dep, pkg_with_dep = pkg_with_dep, dep
+                if not allows_cyclic_dep(pkg_with_dep, dep):
+                    raise graphlib.CycleError("nodes are in a cycle", cycle)
+
+            cyclic_edges.append((pkg_with_dep, dep))
+            graph[pkg_with_dep.name].remove(dep.name)
+            dependents[dep.name].remove(pkg_with_dep.name)
+            indegree[pkg_with_dep.name] -= 1
+            if indegree[pkg_with_dep.name] == 0:
+                ready.append(pkg_with_dep.name)
+
+        return build_pkgs, cyclic_edges
+
+    def _find_cycle(
+        self,
+        graph: dict[mpkg_base.NormalizedName, set[mpkg_base.NormalizedName]],
+        indegree: dict[mpkg_base.NormalizedName, int],
+    ) -> list[mpkg_base.NormalizedName]:
+        # Every node left unsorted has at least one unsorted dependency,
+        # so following those from any such node must eventually loop.
+        # In the returned cycle each node depends on the next one, and
+        # the first node is repeated at the end.  graphlib.CycleError
+        # lists cycles the other way around (each node is a predecessor
+        # of the next), but only two-node cycles are ever broken, where
+        # both orders name the same edges.
+        node = next(n for n, d in indegree.items() if d > 0)
+        path: list[mpkg_base.NormalizedName] = []
+        seen: dict[mpkg_base.NormalizedName, int] = {}
+        while node not in seen:
+            seen[node] = len(path)
+            path.append(node)
+            node = next(d for d in graph[node] if indegree[d] > 0)
+
+        return path[seen[node] :] + [node]
 
     def _check_dep_consistency(
         self,
         packages: list[mpkg_base.BasePackage],
         build_pkgs: list[mpkg_base.BasePackage],
-    ) -> list[poetry_dep.Dependency]:
+    ) -> list[tuple[mpkg_base.NormalizedName, poetry_version.Version]]:
         build_dep_index = {pkg.name: pkg for pkg in build_pkgs}
         reresolve_deps = []
         for pkg in packages:
             build_dep = build_dep_index.get(pkg.name)
             if build_dep is not None and build_dep.version != pkg.version:
-                reresolve_deps.append(
-                    poetry_dep.Dependency(build_dep.name, build_dep.version)
-                )
+                reresolve_deps.append((build_dep.name, build_dep.version))
 
         return reresolve_deps
 
     def _clamp_rlimit_nofile(self) -> None:
-        if sys.platform == "win32":
-            return
-
-        try:
-            import resource
-        except ImportError:
-            pass
-        else:
+        if sys.platform != "win32":
             try:
                 fno_soft, fno_hard = resource.getrlimit(resource.RLIMIT_NOFILE)
             except resource.error:
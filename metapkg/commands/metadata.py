@@ -1,14 +1,10 @@
 from __future__ import annotations
 
-import importlib
 import json
 import pathlib
 import sys
 
 from cleo.helpers import argument, option
-from poetry.utils import env as poetry_env
-
-from metapkg import targets
 
 from . import base
 
@@ -53,6 +49,12 @@ class Metadata(base.Command):
     _loggers = ["metapkg.metadata"]
 
     def handle(self) -> int:
+        import importlib
+
+        from poetry.utils import env as poetry_env
+
+        from metapkg import targets
+
         pkgname = self.argument("name")
         generic = self.option("generic")
         libc = self.option("libc")
@@ -46,6 +46,7 @@ from poetry.repositories import exceptions as poetry_repo_exc
 from metapkg import tools
 from . import repository
 from . import sources as af_sources
+from . import utils as mpkg_utils
 
 if TYPE_CHECKING:
     from typing_extensions import TypeAlias
@@ -56,7 +57,7 @@ if TYPE_CHECKING:
 
 get_build_requirements = repository.get_build_requirements
 set_build_requirements = repository.set_build_requirements
-canonicalize_name = packaging.utils.canonicalize_name
+canonicalize_name = mpkg_utils.canonicalize_name
 NormalizedName = packaging.utils.NormalizedName
 all_requires_include_build_reqs: bool = False
 
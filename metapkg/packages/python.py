@@ -2,19 +2,29 @@ from __future__ import annotations
 from typing import (
     TYPE_CHECKING,
     Any,
+    Collection,
+    Iterator,
     Type,
     TypeVar,
 )
 
-import copy
+import atexit
+import collections
+import concurrent.futures
+import contextlib
+import dataclasses
 import functools
+import hashlib
 import pathlib
 import re
 import shlex
+import sys
 import tempfile
 import textwrap
+import threading
 
 from poetry.core.packages import dependency as poetry_dep
+from poetry.core.packages import dependency_group as poetry_depgroup
 from poetry.core.packages import package as poetry_pkg
 from poetry.core.constraints import version as poetry_version
 from poetry.repositories import pypi_repository
@@ -24,18 +34,22 @@ from poetry.utils import cache as poetry_cache
 import build as pypa_build
 import build.env as pypa_build_env
 import packaging.version
-import packaging.utils
 
 import pyproject_hooks
 
 import distlib.database
 
+from cleo.io import null_io as cleo_null_io
+
+from metapkg import cache
 from metapkg import packages as mpkg
 from metapkg import targets
 
 from . import base
 from . import sources as af_sources
 from . import repository
+from .utils import canonicalize_name
+from .utils import pypkg_dependency
 from .utils import python_dependency_from_pep_508
 
 
@@ -49,6 +63,17 @@ wheel_dependency = poetry_dep.Dependency(name="pypkg-wheel", constraint="*")
 def set_python_runtime_dependency(dep: poetry_dep.Dependency) -> None:
     global python_dependency
     python_dependency = dep
+    _constraint_allows_any.cache_clear()
+
+
+@functools.lru_cache(maxsize=256)
+def _constraint_allows_any(
+    a: poetry_version.VersionConstraint,
+    b: poetry_version.VersionConstraint,
+) -> bool:
+    # Only a handful of distinct python constraints are used across
+    # all dependencies, and version constraint intersection is slow.
+    return a.allows_any(b)
 
 
 class PyPiRepository(pypi_repository.PyPiRepository):
@@ -62,6 +87,16 @@ class PyPiRepository(pypi_repository.PyPiRepository):
         self._dep_cache: poetry_cache.FileCache[list[str]] = (
             poetry_cache.FileCache(path=self._cache_dir)
         )
+        # Each worker may download an sdist and run build backend hooks,
+        # keep their number small.
+        self._build_reqs_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=4,
+            thread_name_prefix="metapkg-build-reqs",
+        )
+        self._build_reqs_futures: dict[
+            str, concurrent.futures.Future[list[str]]
+        ] = {}
+        self._json_cache: dict[str, dict[str, Any] | None] = {}
 
     def register_package_impl(
         self,
@@ -83,9 +118,7 @@ class PyPiRepository(pypi_repository.PyPiRepository):
         packages = super().find_packages(dependency)
 
         for package in packages:
-            package._name = packaging.utils.canonicalize_name(
-                f"pypkg-{package._name}"
-            )
+            package._name = canonicalize_name(f"pypkg-{package._name}")
             package._pretty_name = f"pypkg-{package._pretty_name}"
 
         return packages
@@ -118,69 +151,72 @@ class PyPiRepository(pypi_repository.PyPiRepository):
             source_url=source.url,
         )
 
+        # The upstream package is built from scratch on every call and
+        # is not referenced after this, so its attributes can be taken
+        # over as they are instead of being deep-copied.
         package.__dict__.update(
             {
-                k: copy.deepcopy(v)
+                k: v
                 for k, v in orig_package.__dict__.items()
                 if k
                 not in {"_name", "_pretty_name", "_source_url", "_source_type"}
             }
         )
 
-        for dep in list(package.requires):
+        requires = [
+            pypkg_dependency(dep)
+            for dep in package.requires
             # Some packages like to hard-depend on PyPI version
             # of typing, which is out-of-date at this moment, so
             # filter it out.
-            if dep.name == "typing":
-                continue
-            if not dep.python_constraint.allows_any(
-                python_dependency.constraint
-            ):
-                continue
-            dep._name = packaging.utils.canonicalize_name(f"pypkg-{dep.name}")
-            dep._pretty_name = f"pypkg-{dep.pretty_name}"
-            package.add_dependency(dep)
-
-        for opt_deps in package.extras.values():
-            for dep in opt_deps:
-                dep._name = packaging.utils.canonicalize_name(
-                    f"pypkg-{dep.name}"
-                )
-                dep._pretty_name = f"pypkg-{dep.pretty_name}"
-
-        package.add_dependency(python_dependency)
-        for req in package.get_requirements():
-            package.add_dependency(req)
-        package.source = self.get_sdist_source(pypi_info)
-
-        if self._disable_cache:
-            build_reqs = self._get_build_requires(package)
-        else:
-            build_reqs = self._dep_cache.remember(
-                f"{package.unique_name}:build-requirements",
-                lambda: self._get_build_requires(package),
+            if dep.name != "typing"
+            and _constraint_allows_any(
+                dep.python_constraint, python_dependency.constraint
             )
+        ]
+        package.extras = {
+            extra: [pypkg_dependency(dep) for dep in opt_deps]
+            for extra, opt_deps in package.extras.items()
+        }
 
-        build_reqs.extend(
-            dep.to_pep_508() for dep in package.get_build_requirements()
+        # Replace the upstream dependencies with the filtered pypkg- ones.
+        main_group = poetry_depgroup.DependencyGroup(
+            poetry_depgroup.MAIN_GROUP
         )
+        main_group._dependencies = [
+            *requires,
+            python_dependency,
+            *package.get_requirements(),
+        ]
+        package._dependency_groups = {poetry_depgroup.MAIN_GROUP: main_group}
+        package.source = source
+
+        # Computing build requirements means setting up an isolated
+        # build environment, which is slow, so do it in the background
+        # and only wait for the result once something asks for it.
+        build_reqs_future = self._get_build_requires_future(package)
+
+        def get_build_requirements() -> list[poetry_dep.Dependency]:
+            build_reqs = list(build_reqs_future.result())
+            build_reqs.extend(
+                dep.to_pep_508() for dep in package.get_build_requirements()
+            )
 
-        if package.name == "pypkg-setuptools":
-            build_reqs.append(wheel_dependency.to_pep_508())
+            if package.name == "pypkg-setuptools":
+                build_reqs.append(wheel_dependency.to_pep_508())
 
-        repository.set_build_requirements(
-            package,
-            [
+            return [
                 poetry_dep.Dependency.create_from_pep_508(req)
                 for req in build_reqs
-            ],
-        )
+            ]
+
+        repository.set_lazy_build_requirements(package, get_build_requirements)
 
         return package
 
     def get_package_info(self, name: base.NormalizedName) -> dict[str, Any]:
         if name.startswith("pypkg-"):
-            name = packaging.utils.canonicalize_name(name[len("pypkg-") :])
+            name = canonicalize_name(name[len("pypkg-") :])
 
         return super().get_package_info(name)
 
@@ -206,6 +242,24 @@ class PyPiRepository(pypi_repository.PyPiRepository):
 
         return source
 
+    def _get(
+        self,
+        endpoint: str,
+        headers: dict[str, str] | None = None,
+    ) -> dict[str, Any] | None:
+        # The release JSON of every package is requested twice, once
+        # by poetry for the release info and once by get_pypi_info(),
+        # so keep the responses around.
+        if headers is not None:
+            return super()._get(endpoint, headers=headers)
+
+        try:
+            return self._json_cache[endpoint]
+        except KeyError:
+            json_data = super()._get(endpoint)
+            self._json_cache[endpoint] = json_data
+            return json_data
+
     def get_pypi_info(
         self, name: str, version: poetry_version.Version
     ) -> dict[str, Any]:
@@ -220,18 +274,36 @@ class PyPiRepository(pypi_repository.PyPiRepository):
             return json_data
 
     def _get_sdist_info(self, pypi_info: dict[str, Any]) -> dict[str, Any]:
-        name = pypi_info["info"]["name"]
-        sdist_info = None
-
-        for file_info in pypi_info["urls"]:
-            if file_info["packagetype"] == "sdist":
-                sdist_info = file_info
-                break
-
+        sdist_info: dict[str, Any] | None = next(
+            (f for f in pypi_info["urls"] if f["packagetype"] == "sdist"),
+            None,
+        )
         if sdist_info is None:
+            name = pypi_info["info"]["name"]
             raise LookupError(f"No sdist URL for {name}")
 
-        return sdist_info  # type: ignore
+        return sdist_info
+
+    def _get_build_requires_future(
+        self,
+        package: BasePythonPackage,
+    ) -> concurrent.futures.Future[list[str]]:
+        key = f"{package.unique_name}:build-requirements"
+        future = self._build_reqs_futures.get(key)
+        if future is None:
+            if self._disable_cache:
+                future = self._build_reqs_executor.submit(
+                    self._get_build_requires, package
+                )
+            else:
+                future = self._build_reqs_executor.submit(
+                    self._dep_cache.remember,
+                    key,
+                    lambda: self._get_build_requires(package),
+                )
+            self._build_reqs_futures[key] = future
+
+        return future
 
     def _get_build_requires(
         self,
@@ -239,46 +311,193 @@ class PyPiRepository(pypi_repository.PyPiRepository):
     ) -> list[str]:
         with tempfile.TemporaryDirectory() as t:
             tmpdir = pathlib.Path(t)
-            package.source.copy(tmpdir, io=self._io)
+            # This runs on a worker thread, keep download progress off
+            # the shared output.
+            package.source.copy(tmpdir, io=cleo_null_io.NullIO())
             reqs = get_build_requires_from_srcdir(package, tmpdir)
 
         return [req.to_pep_508() for req in reqs]
 
 
+@dataclasses.dataclass
+class _IsolatedEnvLease:
+    env: pypa_build_env.DefaultIsolatedEnv
+    reusable: bool = True
+
+    def install(self, requirements: Collection[str]) -> None:
+        if requirements:
+            # Anything on top of the build system requirements
+            # makes the environment specific to this source tree.
+            self.reusable = False
+            self.env.install(requirements)
+
+
+class _IsolatedEnvPool:
+    """Isolated build environments shared by build system requirements.
+
+    Creating an environment and installing the build backend into it
+    is by far the slowest part of running the PEP 517 hooks, and most
+    source trees ask for the same few backends.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._idle: dict[
+            frozenset[str], list[pypa_build_env.DefaultIsolatedEnv]
+        ] = collections.defaultdict(list)
+        atexit.register(self.close)
+
+    @contextlib.contextmanager
+    def isolated_env(
+        self,
+        build_system_requires: Collection[str],
+    ) -> Iterator[_IsolatedEnvLease]:
+        key = frozenset(build_system_requires)
+        with self._lock:
+            idle = self._idle[key]
+            env = idle.pop() if idle else None
+
+        if env is None:
+            env = pypa_build_env.DefaultIsolatedEnv()
+            env.__enter__()
+            try:
+                env.install(key)
+            except BaseException:
+                env.__exit__(None, None, None)
+                raise
+
+        lease = _IsolatedEnvLease(env=env)
+        try:
+            yield lease
+        except BaseException:
+            lease.reusable = False
+            raise
+        finally:
+            if lease.reusable:
+                with self._lock:
+                    self._idle[key].append(env)
+            else:
+                env.__exit__(None, None, None)
+
+    def close(self) -> None:
+        with self._lock:
+            idle = [env for envs in self._idle.values() for env in envs]
+            self._idle.clear()
+
+        for env in idle:
+            env.__exit__(None, None, None)
+
+
+_isolated_env_pool = _IsolatedEnvPool()
+
+
+def _get_build_system_requires(srcdir: pathlib.Path) -> set[str]:
+    # This only reads pyproject.toml and needs no environment.
+    return pypa_build.ProjectBuilder(srcdir).build_system_requires
+
+
 def get_dist(
     srcdir: pathlib.Path,
 ) -> distlib.database.InstalledDistribution:
-    with pypa_build_env.DefaultIsolatedEnv() as env:
+    sys_reqs = _get_build_system_requires(srcdir)
+    with _isolated_env_pool.isolated_env(sys_reqs) as lease:
         builder = pypa_build.ProjectBuilder.from_isolated_env(
-            env,
+            lease.env,
             srcdir,
             runner=pyproject_hooks.default_subprocess_runner,
         )
-        env.install(builder.build_system_requires)
-        env.install(builder.get_requires_for_build("wheel"))
+        lease.install(builder.get_requires_for_build("wheel"))
         with tempfile.TemporaryDirectory() as tmpdir:
             distinfo = builder.metadata_path(tmpdir)
             return distlib.database.InstalledDistribution(distinfo)
 
 
+# Files that determine what the PEP 517 build requirements hooks
+# return for a source tree.
+_BUILD_METADATA_FILES = ("pyproject.toml", "setup.py", "setup.cfg")
+
+# The cache key does not cover the version of the build backend, as
+# that is only known once an isolated environment has been set up,
+# and avoiding that is the point of the cache.  A backend pinned in
+# build-system.requires is covered by pyproject.toml, but an unpinned
+# one may be upgraded and start returning different dynamic build
+# requirements, so cached results are only trusted for a day.
+_BUILD_REQUIRES_CACHE_MINUTES = 24 * 60
+
+
+@functools.cache
+def _get_build_requires_cache() -> poetry_cache.FileCache[list[str]]:
+    return poetry_cache.FileCache(path=cache.cachedir() / "build-requires")
+
+
+def _get_build_requires_cache_key(
+    package: mpkg.BasePackage,
+    path: pathlib.Path,
+    salt: str,
+) -> str:
+    digest = hashlib.sha256()
+    digest.update(
+        f"{package.name}\0{sys.implementation.cache_tag}\0"
+        f"{sys.platform}\0{salt}\0".encode()
+    )
+    for filename in _BUILD_METADATA_FILES:
+        try:
+            data = (path / filename).read_bytes()
+        except FileNotFoundError:
+            digest.update(f"{filename}:-\0".encode())
+        else:
+            digest.update(f"{filename}:{len(data)}\0".encode())
+            digest.update(data)
+
+    return digest.hexdigest()
+
+
 def get_build_requires_from_srcdir(
     package: mpkg.BasePackage,
     path: pathlib.Path,
+    *,
+    cache_salt: str = "",
 ) -> list[poetry_dep.Dependency]:
-    with pypa_build_env.DefaultIsolatedEnv() as env:
+    key = _get_build_requires_cache_key(package, path, cache_salt)
+    reqs = _get_build_requires_cache().remember(
+        key,
+        lambda: _run_build_requires_hooks(package, path),
+        minutes=_BUILD_REQUIRES_CACHE_MINUTES,
+    )
+
+    deps = []
+    for req in reqs:
+        dep = python_dependency_from_pep_508(req)
+        # Make sure "wheel" is not a dependency of itself.
+        if (
+            package.name in {"pypkg-wheel", "pypkg-setuptools"}
+            and dep.name == "pypkg-wheel"
+        ):
+            dep.deactivate()
+
+        if dep.is_activated():
+            deps.append(dep)
+
+    return deps
+
+
+def _run_build_requires_hooks(
+    package: mpkg.BasePackage,
+    path: pathlib.Path,
+) -> list[str]:
+    sys_reqs = _get_build_system_requires(path)
+    with _isolated_env_pool.isolated_env(sys_reqs) as lease:
         builder = pypa_build.ProjectBuilder.from_isolated_env(
-            env,
+            lease.env,
             path,
             runner=pyproject_hooks.default_subprocess_runner,
         )
-        sys_reqs = builder.build_system_requires
-        env.install(sys_reqs)
         if package.name == "pypkg-setuptools-rust":
             # setuptools-rust depends on semantic-version and since
             # the former installs itself as a setuptools plugin the
             # get_requires_for_build() hook somehow fails miserably
             # (possibly due to https://github.com/pypa/setuptools/issues/4417)
-            env.install(["semantic-version"])
+            lease.install(["semantic-version"])
         if package.name == "pypkg-setuptools":
             # get_requires_for_build crashes on setuptools with
             # 'MinimalDistribution' object has no attribute 'entry_points'
@@ -287,20 +506,7 @@ def get_build_requires_from_srcdir(
         else:
             pkg_reqs = builder.get_requires_for_build("wheel")
 
-    deps = []
-    for req in sys_reqs | pkg_reqs:
-        dep = python_dependency_from_pep_508(req)
-        # Make sure "wheel" is not a dependency of itself.
-        if (
-            package.name in {"pypkg-wheel", "pypkg-setuptools"}
-            and dep.name == "pypkg-wheel"
-        ):
-            dep.deactivate()
-
-        if dep.is_activated():
-            deps.append(dep)
-
-    return deps
+    return sorted(sys_reqs | pkg_reqs)
 
 
 def is_build_system_bootstrap_package(
@@ -357,11 +563,53 @@ def _best_effort_version(version: str) -> str:
 # SPDX-SnippetEnd
 
 
+@functools.cache
 def get_dist_info_dirname(name: base.NormalizedName, version: str) -> str:
     version = _best_effort_version(version).replace("-", "_").strip("_")
     return f"{name.replace('-', '_')}-{version}.dist-info"
 
 
+_WHEELDIR_SCRIPT = 'import pathlib; print(pathlib.Path(".").resolve())'
+_ABSPATH_SCRIPT = (
+    "import pathlib, sys; print(pathlib.Path(sys.argv[1]).resolve())"
+)
+
+# Lists the files installed from a wheel based on its RECORD.
+_INSTALL_LIST_SCRIPT = textwrap.dedent(
+    """\
+    import pathlib
+    import site
+
+    sitepackages = pathlib.Path(site.getsitepackages(["{prefix}"])[0])
+    abs_sitepackages = (
+        pathlib.Path("{dest}") /
+        sitepackages.relative_to('/')
+    )
+
+    record = abs_sitepackages / "{dist_info_dir}" / "RECORD"
+    if not record.exists():
+        raise RuntimeError(f'no wheel RECORD for {name}')
+
+    entries = set()
+
+    with open(record) as f:
+        for entry in f:
+            filename = entry.split(',')[0]
+            install_path = (sitepackages / filename).resolve()
+            rel_install_path = install_path.relative_to('/')
+            if rel_install_path.parent.name == "bin":
+                # Avoid installing entry point scripts,
+                # have packages opt-in explicitly.
+                continue
+            entries.add(rel_install_path)
+            entries.update(rel_install_path.parents)
+
+    for entry in sorted(entries):
+        print(entry)
+"""
+)
+
+
 class BasePythonPackage(base.BasePackage):
     source: af_sources.BaseSource
     dist_name: base.NormalizedName
@@ -405,12 +653,6 @@ class BasePythonPackage(base.BasePackage):
             f'import site; print(site.getsitepackages(["{src_dest}"])[0])'
         )
 
-        wheeldir_script = 'import pathlib; print(pathlib.Path(".").resolve())'
-
-        abspath = (
-            "import pathlib, sys; print(pathlib.Path(sys.argv[1]).resolve())"
-        )
-
         dist_name = self.get_dist_name()
         env = build.sh_append_global_flags(
             {
@@ -500,10 +742,10 @@ class BasePythonPackage(base.BasePackage):
 
         return textwrap.dedent(
             f"""\
-            _wheeldir=$("{build_python}" -c '{wheeldir_script}')
+            _wheeldir=$("{build_python}" -c '{_WHEELDIR_SCRIPT}')
             _target=$("{build_python}" -c '{sitescript}')
             _sitepkg_from_src=$("{build_python}" -c '{src_sitescript}')
-            _wd=$("{build_python}" -c '{abspath}' "$(pwd)")
+            _wd=$("{build_python}" -c '{_ABSPATH_SCRIPT}' "$(pwd)")
             (
                 cd "{sdir}"
                 {textwrap.indent(build_command, ' ' * 16)}
@@ -532,7 +774,6 @@ class BasePythonPackage(base.BasePackage):
 
         python = build.sh_get_command("python", package=self)
         root = build.get_build_install_dir(self, relative_to="pkgbuild")
-        wheeldir_script = 'import pathlib; print(pathlib.Path(".").resolve())'
 
         dist_name = self.get_dist_name()
 
@@ -546,7 +787,7 @@ class BasePythonPackage(base.BasePackage):
 
         wheel_install = textwrap.dedent(
             f"""\
-            _wheeldir=$("{python}" -c '{wheeldir_script}')
+            _wheeldir=$("{python}" -c '{_WHEELDIR_SCRIPT}')
             {env_str} \\
             "{python}" -m pip install \\
                 --no-build-isolation \\
@@ -622,38 +863,11 @@ class BasePythonPackage(base.BasePackage):
             self.pretty_version,
         )
 
-        pyscript = textwrap.dedent(
-            f"""\
-            import pathlib
-            import site
-
-            sitepackages = pathlib.Path(site.getsitepackages(["{prefix}"])[0])
-            abs_sitepackages = (
-                pathlib.Path("{dest}") /
-                sitepackages.relative_to('/')
-            )
-
-            record = abs_sitepackages / "{dist_info_dir}" / "RECORD"
-            if not record.exists():
-                raise RuntimeError(f'no wheel RECORD for {self.name}')
-
-            entries = set()
-
-            with open(record) as f:
-                for entry in f:
-                    filename = entry.split(',')[0]
-                    install_path = (sitepackages / filename).resolve()
-                    rel_install_path = install_path.relative_to('/')
-                    if rel_install_path.parent.name == "bin":
-                        # Avoid installing entry point scripts,
-                        # have packages opt-in explicitly.
-                        continue
-                    entries.add(rel_install_path)
-                    entries.update(rel_install_path.parents)
-
-            for entry in sorted(entries):
-                print(entry)
-        """
+        pyscript = _INSTALL_LIST_SCRIPT.format(
+            prefix=prefix,
+            dest=dest,
+            dist_info_dir=dist_info_dir,
+            name=self.name,
         )
 
         scriptfile_name = f"_gen_install_list_from_wheel_{self.unique_name}.py"
@@ -737,7 +951,9 @@ class BundledPythonPackage(BasePythonPackage, base.BundledPackage):
         package.dist_name = base.canonicalize_name(dist.name)
         repository.set_build_requirements(
             package,
-            get_build_requires_from_srcdir(package, repo_dir)
+            get_build_requires_from_srcdir(
+                package, repo_dir, cache_salt=repo.head
+            )
             + package.get_build_requirements(),
         )
 
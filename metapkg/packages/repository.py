@@ -1,13 +1,18 @@
 from __future__ import annotations
 from typing import (
     TYPE_CHECKING,
+    Any,
+    Callable,
     Collection,
     Iterator,
+    Sequence,
 )
 
+import concurrent.futures
 import contextlib
 import copy
 import itertools
+import os
 import pathlib
 
 import packaging.utils
@@ -24,6 +29,7 @@ from poetry.puzzle import provider as poetry_provider
 from poetry.vcs import git as poetry_git
 
 from . import sources as mpkg_sources
+from . import utils as mpkg_utils
 
 if TYPE_CHECKING:
     from cleo.io import io as cleo_io
@@ -34,22 +40,39 @@ class Pool(poetry_pool.RepositoryPool):
 
 
 class BundleRepository(poetry_repo.Repository):
+    def __init__(
+        self,
+        name: str,
+        packages: Sequence[poetry_pkg.Package] | None = None,
+    ) -> None:
+        # Must be set before super().__init__(), which adds packages.
+        self._package_index: dict[str, poetry_pkg.Package] = {}
+        super().__init__(name, packages)
+
+    def has_package(self, package: poetry_pkg.Package) -> bool:
+        return package.unique_name in self._package_index
+
     def add_package(self, package: poetry_pkg.Package) -> None:
         if not self.has_package(package):
+            self._package_index[package.unique_name] = package
             super().add_package(package)
 
     def remove_package(self, package: poetry_pkg.Package) -> None:
-        index = None
-        for i, repo_package in enumerate(self.packages):
-            if repo_package == package:
-                index = i
-                break
-
-        if index is not None:
-            del self._packages[index]
+        repo_package = self._package_index.get(package.unique_name)
+        if repo_package is not None and repo_package == package:
+            del self._package_index[package.unique_name]
+            self._packages.remove(repo_package)
 
 
 bundle_repo = BundleRepository("bundled")
+_vcs_build_reqs_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=min(8, os.cpu_count() or 1),
+    thread_name_prefix="metapkg-vcs-build-reqs",
+)
+# Build requirement hooks still running against a checkout directory.
+_vcs_build_reqs_pending: dict[
+    pathlib.Path, concurrent.futures.Future[list[poetry_dep.Dependency]]
+] = {}
 
 
 class Provider(poetry_provider.Provider):
@@ -76,6 +99,20 @@ class Provider(poetry_provider.Provider):
     ) -> poetry_pkg.Package:
         from . import python
 
+        source_root = self._source_root or (
+            self._env.path.joinpath("src") if self._env else None
+        )
+
+        # The checkout is about to be updated, so let any hooks still
+        # reading it finish first.  Their errors are reported by whoever
+        # asks for their result.
+        checkout_dir = (
+            source_root or poetry_git.Git.get_default_source_root()
+        ) / poetry_git.Git.get_name_from_source_url(url=dependency.source)
+        pending = _vcs_build_reqs_pending.pop(checkout_dir, None)
+        if pending is not None:
+            concurrent.futures.wait([pending])
+
         pkg = self._direct_origin.get_package_from_vcs(
             dependency.vcs,
             dependency.source,
@@ -83,10 +120,7 @@ class Provider(poetry_provider.Provider):
             tag=dependency.tag,
             rev=dependency.rev,
             subdirectory=dependency.source_subdirectory,
-            source_root=(
-                self._source_root
-                or (self._env.path.joinpath("src") if self._env else None)
-            ),
+            source_root=source_root,
         )
 
         pkg.develop = dependency.develop
@@ -96,24 +130,29 @@ class Provider(poetry_provider.Provider):
             version=pkg.version,
             pretty_version=pkg.pretty_version,
         )
+        # The upstream package is cached by poetry, so the dependencies,
+        # which get renamed below, must be copied.  Everything else is
+        # never mutated and can be shared.
+        memo: dict[int, Any] = {}
         package.__dict__.update(
             {
-                k: copy.deepcopy(v)
+                k: (
+                    copy.deepcopy(v, memo)
+                    if k in {"_dependency_groups", "_extras"}
+                    else v
+                )
                 for k, v in pkg.__dict__.items()
                 if k not in {"_name", "_pretty_name"}
             }
         )
 
         for dep in package.all_requires:
-            dep._name = packaging.utils.canonicalize_name(f"pypkg-{dep.name}")
+            dep._name = mpkg_utils.canonicalize_name(f"pypkg-{dep.name}")
             dep._pretty_name = f"pypkg-{dep.pretty_name}"
 
         source = poetry_git.Git.clone(
             url=dependency.source,
-            source_root=(
-                self._source_root
-                or (self._env.path.joinpath("src") if self._env else None)
-            ),
+            source_root=source_root,
             branch=dependency.branch,
             tag=dependency.tag,
             revision=dependency.rev,
@@ -122,11 +161,17 @@ class Provider(poetry_provider.Provider):
         if dependency.source_subdirectory:
             path = path.joinpath(dependency.source_subdirectory)
 
-        breqs = (
-            python.get_build_requires_from_srcdir(package, path)
-            + package.get_build_requirements()
+        # Running the build backend hooks is slow, so let the solver
+        # carry on in the meantime.
+        breqs_future = _vcs_build_reqs_executor.submit(
+            python.get_build_requires_from_srcdir, package, path
         )
-        set_build_requirements(package, breqs)
+        _vcs_build_reqs_pending[checkout_dir] = breqs_future
+
+        def get_build_requirements() -> list[poetry_dep.Dependency]:
+            return breqs_future.result() + package.get_build_requirements()
+
+        set_lazy_build_requirements(package, get_build_requirements)
 
         package.source = mpkg_sources.source_for_url(f"file://{path}")
 
@@ -147,6 +192,10 @@ class Provider(poetry_provider.Provider):
         self,
         dependency_package: poetry_deppkg.DependencyPackage,
     ) -> poetry_deppkg.DependencyPackage:
+        if not self._active_extras:
+            # Nothing below can match without active extras.
+            return super().complete_package(dependency_package)
+
         chain = [dependency_package.package.all_requires]
         build_requires = get_build_requirements(dependency_package.package)
         if build_requires:
@@ -155,8 +204,10 @@ class Provider(poetry_provider.Provider):
         pkg = super().complete_package(dependency_package)
 
         for dep in itertools.chain.from_iterable(chain):
+            if not dep.in_extras:
+                continue
             dep_in_extras = {str(e) for e in dep.in_extras}
-            if dep_in_extras and not (dep_in_extras - self._active_extras):
+            if dep_in_extras <= self._active_extras:
                 dep.activate()
                 pkg.package.add_dependency(dep)
 
@@ -170,23 +221,21 @@ def extra_requirements(
     if not pkg.has_dependency_group(poetry_depgroup.MAIN_GROUP):
         dep_group = poetry_depgroup.DependencyGroup(poetry_depgroup.MAIN_GROUP)
         pkg.add_dependency_group(dep_group)
-        orig_reqs = []
     else:
         dep_group = pkg.dependency_group(poetry_depgroup.MAIN_GROUP)
-        orig_reqs = list(dep_group.dependencies)
 
+    saved_reqs = dep_group._dependencies
+    orig_reqs = dep_group.dependencies
     orig_req_names = {d.name for d in orig_reqs}
 
-    all_reqs = orig_reqs + [d for d in reqs if d.name not in orig_req_names]
+    dep_group._dependencies = orig_reqs + [
+        d for d in reqs if d.is_activated() and d.name not in orig_req_names
+    ]
 
     try:
-        for dep in all_reqs:
-            if dep.is_activated():
-                dep_group.add_dependency(dep)
-
         yield
     finally:
-        dep_group._dependencies = orig_reqs
+        dep_group._dependencies = saved_reqs
 
 
 def set_build_requirements(
@@ -195,7 +244,29 @@ def set_build_requirements(
     setattr(pkg, "build_requires", list(reqs))
 
 
+def set_lazy_build_requirements(
+    pkg: poetry_pkg.Package,
+    resolver: Callable[[], list[poetry_dep.Dependency]],
+) -> None:
+    # The resolver is called the first time build requirements of
+    # the package are requested.
+    setattr(pkg, "build_requires", resolver)
+
+
 def get_build_requirements(
     pkg: poetry_pkg.Package,
 ) -> list[poetry_dep.Dependency]:
-    return getattr(pkg, "build_requires", [])
+    # Most packages the solver asks about never had build requirements
+    # set, so look in the instance dict directly rather than have
+    # getattr() raise and swallow an AttributeError for every miss.
+    reqs: (
+        list[poetry_dep.Dependency]
+        | Callable[[], list[poetry_dep.Dependency]]
+        | None
+    ) = pkg.__dict__.get("build_requires")
+    if reqs is None:
+        return []
+    elif callable(reqs):
+        reqs = reqs()
+        setattr(pkg, "build_requires", reqs)
+    return reqs
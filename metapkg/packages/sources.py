@@ -148,8 +148,7 @@ class BaseSource:
 class HttpsSource(BaseSource):
     def download(self, io: cleo_io.IO) -> pathlib.Path:
         destination_dir = cache.cachedir() / "distfiles"
-        if not destination_dir.exists():
-            destination_dir.mkdir()
+        destination_dir.mkdir(exist_ok=True)
 
         destination = destination_dir / self.name
         if destination.exists():
@@ -199,6 +198,14 @@ class HttpsSource(BaseSource):
 
         return destination
 
+    def _is_plain_tarball(self, src: pathlib.Path) -> bool:
+        if "archive" in self.extras and not self.extras["archive"]:
+            return False
+        else:
+            return src.suffix in {".tgz", ".tbz2"} or (
+                src.suffix != ".tar" and ".tar" in src.suffixes
+            )
+
     def _tarball(
         self,
         pkg: typing.Optional[mpkg.BasePackage] = None,
@@ -277,7 +284,13 @@ class HttpsSource(BaseSource):
         *,
         io: cleo_io.IO,
     ) -> None:
-        self.download(io)
+        src = self.download(io)
+        if self._is_plain_tarball(src):
+            # No repackaging needed, so unpack straight from the
+            # download cache instead of copying the archive first.
+            unpack(src, dest=target_dir, io=io)
+            return
+
         with tempfile.TemporaryDirectory() as t:
             tardir = pathlib.Path(t)
             tarball = self._tarball(
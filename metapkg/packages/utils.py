@@ -1,12 +1,29 @@
 from __future__ import annotations
 
+import functools
+
 import packaging.utils
 
 from poetry.core.packages import dependency as poetry_dep
 
 
-def python_dependency_from_pep_508(name: str) -> poetry_dep.Dependency:
-    dep = poetry_dep.Dependency.create_from_pep_508(name)
-    dep._name = packaging.utils.canonicalize_name(f"pypkg-{dep.name}")
+@functools.lru_cache(maxsize=8192)
+def canonicalize_name(name: str) -> packaging.utils.NormalizedName:
+    # The same few hundred names get canonicalized over and over
+    # during dependency resolution.
+    return packaging.utils.canonicalize_name(name)
+
+
+def _rename_to_pypkg(dep: poetry_dep.Dependency) -> poetry_dep.Dependency:
     dep._pretty_name = f"pypkg-{dep.pretty_name}"
+    dep._name = canonicalize_name(f"pypkg-{dep.name}")
     return dep
+
+
+def pypkg_dependency(dep: poetry_dep.Dependency) -> poetry_dep.Dependency:
+    return _rename_to_pypkg(dep.clone())
+
+
+def python_dependency_from_pep_508(name: str) -> poetry_dep.Dependency:
+    # The dependency is brand new, so there is no need to copy it.
+    return _rename_to_pypkg(poetry_dep.Dependency.create_from_pep_508(name))
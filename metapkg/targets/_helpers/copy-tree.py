@@ -22,6 +22,15 @@ logger = logging.getLogger("copy-tree")
 system = platform.system()
 
 
+def get_umask() -> int:
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+umask = get_umask()
+
+
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(
         description="Copies a tree of files to an empty directory."
@@ -45,6 +54,14 @@ def parse_args() -> argparse.Namespace:
         help="Copy all files to the top directory.",
         action="store_true",
     )
+    parser.add_argument(
+        "--link",
+        help=(
+            "Hard-link files into the destination instead of copying them"
+            " where possible."
+        ),
+        action="store_true",
+    )
     parser.add_argument(
         "-v",
         "--verbose",
@@ -65,6 +82,7 @@ def main(
     *,
     files_from: Optional[str],
     flatten: bool,
+    link: bool = False,
 ) -> None:
     dest = ensure_destination(src, dest)
     all_files = list(ensure_relative(get_paths_in(src), src))
@@ -77,12 +95,12 @@ def main(
             f"Using file list in {p} with {len(relative_files)} entries"
         )
         warn_about_excluded_files(included=relative_files, all_files=all_files)
-        copy_files(src, dest, relative_files, flatten=flatten)
+        copy_files(src, dest, relative_files, flatten=flatten, link=link)
     else:
         logger.info(
             f"No file list given, copying all {len(all_files)} entries"
         )
-        copy_files(src, dest, all_files, flatten=flatten)
+        copy_files(src, dest, all_files, flatten=flatten, link=link)
 
 
 def ensure_destination(src: str, dest: str) -> str:
@@ -144,10 +162,15 @@ def copy_files(
     files: Iterable[str],
     *,
     flatten: bool,
+    link: bool = False,
 ) -> None:
     """Copy files listed in `files` from `src` to `dest`.
 
-    Paths in `files` must be relative.
+    Paths in `files` must be relative.  If `link` is true, files are
+    hard-linked rather than copied, unless that fails (e.g. because
+    `src` and `dest` are on different filesystems).  Linked files share
+    their contents with `src`, so anything modifying them in place
+    must replace them with a copy first.
     """
     src_dir = pathlib.Path(src)
     dest_dir = pathlib.Path(dest)
@@ -192,12 +215,24 @@ def copy_files(
                 logger.warning(
                     f"File {path_to} already exists and will be overwritten"
                 )
-            try:
-                shutil.copyfile(path_from, path_to, follow_symlinks=False)
-            except Exception as e:
-                logger.error(f"Failed copying {path_from} -> {path_to}: {e}")
+            if (
+                link
+                and has_copy_mode(path_from)
+                and link_file(path_from, path_to)
+            ):
+                logger.info(f"ln {path_from} -> {path_to}")
+                # The link shares mode and times with the source, and
+                # changing them here would change the source too.
+                continue
             else:
-                logger.info(f"cp {path_from} -> {path_to}")
+                try:
+                    shutil.copyfile(path_from, path_to, follow_symlinks=False)
+                except Exception as e:
+                    logger.error(
+                        f"Failed copying {path_from} -> {path_to}: {e}"
+                    )
+                else:
+                    logger.info(f"cp {path_from} -> {path_to}")
         stat_from = path_from.lstat()
         stat_to = path_to.lstat()
         new_mode = stat_to.st_mode
@@ -227,6 +262,33 @@ def copy_files(
                 pass  # logging `touch -t` is overly verbose
 
 
+def has_copy_mode(path: pathlib.Path) -> bool:
+    """Tell whether a copy of `path` would get the same mode as it has.
+
+    Copies are created with the default mode, plus the exec bits of the
+    source file, so only files with exactly that mode can be linked
+    without changing what ends up in the destination.
+    """
+    st = path.lstat()
+    if stat.S_ISLNK(st.st_mode):
+        return True
+    exec_bits = st.st_mode & (stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return stat.S_IMODE(st.st_mode) == (0o666 & ~umask) | exec_bits
+
+
+def link_file(path_from: pathlib.Path, path_to: pathlib.Path) -> bool:
+    # Never write through an existing destination, it may itself be
+    # a link to another source file.
+    try:
+        if path_to.is_symlink() or path_to.exists():
+            path_to.unlink()
+        os.link(path_from, path_to, follow_symlinks=False)
+    except OSError:
+        return False
+    else:
+        return True
+
+
 def warn_about_excluded_files(
     included: Collection[str], all_files: Collection[str]
 ) -> None:
@@ -264,4 +326,10 @@ if __name__ == "__main__":
         level=logging.INFO if args.verbose else logging.WARNING,
         format="%(asctime)s - %(levelname)s: %(message)s",
     )
-    main(args.src, args.dest, files_from=args.files_from, flatten=args.flatten)
+    main(
+        args.src,
+        args.dest,
+        files_from=args.files_from,
+        flatten=args.flatten,
+        link=args.link,
+    )
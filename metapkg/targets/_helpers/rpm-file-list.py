@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import sys
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Convert a list of installed files to a %files list."
+    )
+    parser.add_argument("file_list", help="List of installed files.")
+    parser.add_argument("install_dir", help="Installation directory.")
+
+    args = parser.parse_args()
+
+    # Directory entries are looked up by listing each parent directory
+    # once, rather than stat()-ing every file in the list.
+    listings: dict[str, dict[str, bool]] = {}
+
+    def is_dir(path: str) -> bool:
+        parent, name = os.path.split(path.rstrip("/"))
+        entries = listings.get(parent)
+        if entries is None:
+            entries = {}
+            try:
+                with os.scandir(os.path.join(args.install_dir, parent)) as it:
+                    for entry in it:
+                        entries[entry.name] = entry.is_dir()
+            except OSError:
+                pass
+            listings[parent] = entries
+        return entries.get(name, False)
+
+    with open(args.file_list, "r") as f:
+        for line in f:
+            path = line.rstrip("\n")
+            if is_dir(path):
+                print(f'%dir "/{path}"')
+            else:
+                print(f'"/{path}"')
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -9,6 +9,7 @@ from typing import (
 )
 
 import collections
+import concurrent.futures
 import datetime
 import hashlib
 import itertools
@@ -764,6 +765,12 @@ class Build:
             list[tuple[mpkg_sources.BaseSource, pathlib.Path]],
         ] = {}
         self._patches: list[tuple[str, str]] = []
+        self._dir_cache: dict[
+            tuple[str, Location, str | None], pathlib.Path
+        ] = {}
+        self._sh_command_cache: dict[
+            tuple[str, str | None, Location, bool], str
+        ] = {}
 
     @property
     def io(self) -> IO:
@@ -949,6 +956,9 @@ class Build:
         self._system_tools["ninja"] = "ninja"
 
     def prepare(self) -> None:
+        # Source roots may be (re)defined by subclass prepare().
+        self._dir_cache.clear()
+        self._sh_command_cache.clear()
         self.define_tools()
 
     def build(self) -> None:
@@ -996,13 +1006,29 @@ class Build:
         relative_to: Location,
         relative_to_package: mpkg_base.BasePackage | None = None,
     ) -> pathlib.Path:
-        absolute_path = (self.get_source_abspath() / path).resolve()
-        if not absolute_path.exists():
-            absolute_path.mkdir(parents=True)
-
-        return self.get_path(
-            path, relative_to=relative_to, package=relative_to_package
+        # The get_*_root() helpers are called a great many times during
+        # a build, so only resolve and create each directory once.
+        key = (
+            str(path),
+            relative_to,
+            (
+                str(relative_to_package.name)
+                if relative_to_package is not None
+                else None
+            ),
         )
+        result = self._dir_cache.get(key)
+        if result is None:
+            absolute_path = (self.get_source_abspath() / path).resolve()
+            if not absolute_path.exists():
+                absolute_path.mkdir(parents=True, exist_ok=True)
+
+            result = self.get_path(
+                path, relative_to=relative_to, package=relative_to_package
+            )
+            self._dir_cache[key] = result
+
+        return result
 
     def get_build_install_dir(
         self,
@@ -1182,6 +1208,37 @@ class Build:
         force_args_eq: bool = False,
         linebreaks: bool = True,
         system_only: bool = False,
+    ) -> str:
+        key = (
+            command,
+            str(package.name) if package is not None else None,
+            relative_to,
+            system_only,
+        )
+        cmd = self._sh_command_cache.get(key)
+        if cmd is None:
+            cmd = self._sh_get_command(
+                command,
+                package=package,
+                relative_to=relative_to,
+                system_only=system_only,
+            )
+            self._sh_command_cache[key] = cmd
+
+        if args is not None:
+            cmd = self.sh_append_args(
+                cmd, args, force_args_eq=force_args_eq, linebreaks=linebreaks
+            )
+
+        return cmd
+
+    def _sh_get_command(
+        self,
+        command: str,
+        *,
+        package: mpkg_base.BasePackage | None,
+        relative_to: Location,
+        system_only: bool,
     ) -> str:
         path = None
         if not system_only:
@@ -1204,11 +1261,6 @@ class Build:
             )
             cmd = shlex.quote(str(rel_path))
 
-        if args is not None:
-            cmd = self.sh_append_args(
-                cmd, args, force_args_eq=force_args_eq, linebreaks=linebreaks
-            )
-
         return cmd
 
     def sh_format_args(
@@ -1368,6 +1420,27 @@ class Build:
 
         return self.sh_write_helper(name, script, relative_to=relative_to)
 
+    def sh_write_bash_functions_helper(
+        self,
+        name: str,
+        functions: Mapping[str, str],
+        *,
+        relative_to: Location,
+    ) -> str:
+        """Write a bash helper that runs the function named by its argument.
+
+        This lets several related scripts share a single helper file.
+        """
+        # The leading no-op keeps the function body valid when the
+        # script text is empty.
+        text = "\n".join(
+            f"{fname}() {{\n:\n{body}\n}}\n"
+            for fname, body in functions.items()
+        )
+        return self.sh_write_bash_helper(
+            name, f'{text}\n"$@"', relative_to=relative_to
+        )
+
     def get_tarball_tpl(self, package: mpkg_base.BasePackage) -> str:
         rp = self._root_pkg
         return f"{rp.name_slot}_{rp.version.text}.orig-{package.name}{{part}}.tar{{comp}}"
@@ -1434,11 +1507,14 @@ class Build:
                 helpers_rel_dir / helper
             )
 
+        # Tool paths have changed, forget any earlier lookups.
+        self._sh_command_cache.clear()
+
     def prepare_tarballs(self) -> None:
         tarball_root = self.get_tarball_root(relative_to="fsroot")
+        source_maps = {}
 
         for pkg in self._bundled:
-            tarball_tpl = self.get_tarball_tpl(pkg)
             source_map = {}
             counter = 0
             for src in pkg.get_sources():
@@ -1451,17 +1527,58 @@ class Build:
                         part = f"-{counter}"
                     counter += 1
                 source_map[src] = part
-
+            source_maps[pkg] = source_map
+
+        # Cloning and updating git repositories is bound by the network,
+        # so work on several of them at once.  Sources sharing a checkout
+        # directory are handled in order by the same worker, as each one
+        # archives whatever its own update left checked out.  Other
+        # sources are handled one after another as well.
+        groups: dict[
+            pathlib.Path | None,
+            list[tuple[mpkg_base.BasePackage, mpkg_sources.BaseSource, str]],
+        ] = {}
+        for pkg, source_map in source_maps.items():
             for source, part in source_map.items():
-                tarball = source.tarball(
+                if isinstance(source, mpkg_sources.GitSource):
+                    key = tools.git.repodir(source.url)
+                else:
+                    key = None
+                groups.setdefault(key, []).append((pkg, source, part))
+
+        tarballs: dict[
+            tuple[mpkg_base.BasePackage, mpkg_sources.BaseSource],
+            pathlib.Path,
+        ] = {}
+
+        def _make_tarballs(
+            entries: list[
+                tuple[mpkg_base.BasePackage, mpkg_sources.BaseSource, str]
+            ],
+        ) -> None:
+            for pkg, source, part in entries:
+                tarballs[pkg, source] = source.tarball(
                     pkg,
-                    tarball_tpl,
+                    self.get_tarball_tpl(pkg),
                     target_dir=tarball_root,
                     io=self._io,
                     build=self,
                     part=part,
                 )
 
+        if len(groups) > 1:
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(8, len(groups))
+            ) as pool:
+                # Consume the results to propagate any errors.
+                list(pool.map(_make_tarballs, groups.values()))
+        else:
+            for entries in groups.values():
+                _make_tarballs(entries)
+
+        for pkg, source_map in source_maps.items():
+            for source in source_map:
+                tarball = tarballs[pkg, source]
                 try:
                     self._tarballs[pkg].append((source, tarball))
                 except KeyError:
@@ -1481,7 +1598,13 @@ class Build:
                 build=self,
             )
         else:
-            for pkg, tarballs in self._tarballs.items():
+
+            def _unpack_package(
+                pkg: mpkg_base.BasePackage,
+                tarballs: list[tuple[mpkg_sources.BaseSource, pathlib.Path]],
+            ) -> None:
+                # Additional tarballs may unpack into subdirectories of
+                # the main one, so a package is always unpacked in order.
                 for src, tarball in tarballs:
                     dest = self.get_source_dir(pkg, relative_to="fsroot")
                     if src.path:
@@ -1501,6 +1624,18 @@ class Build:
                         strip_components=src.extras.get("strip_components", 1),
                     )
 
+            # Different packages unpack into separate source directories,
+            # so extract them concurrently.
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(1, min(len(self._tarballs), self._jobs))
+            ) as pool:
+                futures = [
+                    pool.submit(_unpack_package, pkg, tarballs)
+                    for pkg, tarballs in self._tarballs.items()
+                ]
+                for future in futures:
+                    future.result()
+
     def get_tarballs(
         self,
         pkg: mpkg_base.BasePackage,
@@ -1603,13 +1738,28 @@ class Build:
         else:
             stages = [stage]
 
-        for pkg in packages:
+        def _get_package_scripts(pkg: mpkg_base.BasePackage) -> list[str]:
+            pkg_scripts = []
             for stg in stages:
                 script = self._get_package_script(
                     pkg, stg, relative_to=relative_to
                 )
                 if script.strip():
-                    scripts.append(script)
+                    pkg_scripts.append(script)
+            return pkg_scripts
+
+        if stage == "install" and len(packages) > 1:
+            # Generating the install script writes a number of helper
+            # scripts for every package, so overlap that I/O.
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(8, len(packages))
+            ) as pool:
+                per_package = list(pool.map(_get_package_scripts, packages))
+        else:
+            per_package = [_get_package_scripts(pkg) for pkg in packages]
+
+        for pkg_scripts in per_package:
+            scripts.extend(pkg_scripts)
 
         global_method = getattr(self, f"_get_global_{stage}_script", None)
         if global_method:
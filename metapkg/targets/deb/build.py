@@ -521,24 +521,15 @@ class Build(targets.Build):
         install_dir = self.get_build_install_dir(pkg, relative_to="sourceroot")
         temp_dir = self.get_temp_dir(pkg, relative_to="sourceroot")
 
-        il_script_text = self._get_package_script(pkg, "install_list")
-        il_script = self.sh_write_bash_helper(
-            f"_gen_install_list_{pkg.unique_name}.sh",
-            il_script_text,
-            relative_to="sourceroot",
-        )
-
-        nil_script_text = self._get_package_script(pkg, "no_install_list")
-        nil_script = self.sh_write_bash_helper(
-            f"_gen_no_install_list_{pkg.unique_name}.sh",
-            nil_script_text,
-            relative_to="sourceroot",
-        )
-
-        ignore_script_text = self._get_package_script(pkg, "ignore_list")
-        ignore_script = self.sh_write_bash_helper(
-            f"_gen_ignore_list_{pkg.unique_name}.sh",
-            ignore_script_text,
+        lists_script = self.sh_write_bash_functions_helper(
+            f"_gen_lists_{pkg.unique_name}.sh",
+            {
+                "install_list": self._get_package_script(pkg, "install_list"),
+                "no_install_list": self._get_package_script(
+                    pkg, "no_install_list"
+                ),
+                "ignore_list": self._get_package_script(pkg, "ignore_list"),
+            },
             relative_to="sourceroot",
         )
 
@@ -550,9 +541,9 @@ class Build(targets.Build):
             f"""
             pushd "{source_root}" >/dev/null
 
-            {il_script} > "{temp_dir}/install"
-            {nil_script} > "{temp_dir}/not-installed"
-            {ignore_script} > "{temp_dir}/ignored"
+            {lists_script} install_list > "{temp_dir}/install"
+            {lists_script} no_install_list > "{temp_dir}/not-installed"
+            {lists_script} ignore_list > "{temp_dir}/ignored"
 
             {trim_install} \\
                 "{temp_dir}/install" \\
@@ -1,12 +1,16 @@
 from __future__ import annotations
+from typing import Callable
 
 import collections
+import concurrent.futures
+import functools
 import json
 import os
 import os.path
 import pathlib
 import shlex
 import shutil
+import stat
 import subprocess
 import textwrap
 
@@ -22,6 +26,51 @@ _supported_compression_schemes = {
 }
 
 
+@functools.lru_cache(maxsize=16)
+def _resolve_dir(path: pathlib.Path) -> pathlib.Path:
+    return path.resolve()
+
+
+def _resolve_under(
+    root: pathlib.Path, path: str | pathlib.Path
+) -> pathlib.Path:
+    # A cheaper stand-in for (root / path).resolve().  Only root is
+    # resolved (once), the leading ".." components of path are
+    # collapsed lexically, and the result is fully resolved only if
+    # it is a symlink itself.  Symlinks in the intermediate components
+    # of path are NOT followed, so this is only suitable for paths
+    # whose directories are known to be real, such as symlink targets
+    # within the image.  Absolute paths and paths with ".." after
+    # other components still go through resolve().
+    parts = pathlib.PurePath(path).parts
+    n = 0
+    while n < len(parts) and parts[n] == "..":
+        n += 1
+    if pathlib.PurePath(path).is_absolute() or ".." in parts[n:]:
+        return (root / path).resolve()
+
+    candidate = pathlib.Path(os.path.normpath(_resolve_dir(root) / path))
+    if os.path.islink(candidate):
+        return candidate.resolve()
+    else:
+        return candidate
+
+
+def _unshare_file(path: pathlib.Path) -> None:
+    # Image files may be hard links to the per-package install trees
+    # (see copy-tree --link), so give the image its own copy of a file
+    # before it gets modified in place.
+    # Like any other image file, the copy must be writable for the
+    # tools that patch it in place.
+    st = path.lstat()
+    if st.st_nlink > 1:
+        tmp_path = path.with_name(f".{path.name}.unshare")
+        shutil.copyfile(path, tmp_path)
+        os.chmod(tmp_path, stat.S_IMODE(st.st_mode) | stat.S_IWUSR)
+        os.utime(tmp_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.replace(tmp_path, path)
+
+
 class Build(targets.Build):
     _srcroot: pathlib.Path
     _pkgroot: pathlib.Path
@@ -92,7 +141,7 @@ class Build(targets.Build):
         elif relative_to == "helpers":
             return pathlib.Path("..") / ".." / self._root_pkg.name / path
         elif relative_to == "fsroot":
-            return (self.get_source_abspath() / path).resolve()
+            return _resolve_under(self.get_source_abspath(), path)
         else:
             raise ValueError(f"invalid relative_to argument: {relative_to}")
 
@@ -224,14 +273,36 @@ class Build(targets.Build):
         patch_cmd = shlex.split(self.sh_get_command("patch"))
         dep_root = self.get_dir("thirdparty", relative_to="fsroot")
         my_root = self.get_source_abspath()
+
+        # Patches are rewritten to apply to their own package's source
+        # directory, so the series of different packages can be applied
+        # concurrently, as long as each series is applied in order.
+        series: dict[str, list[str]] = collections.defaultdict(list)
         for pkgname, patchname in self._patches:
+            series[pkgname].append(patchname)
+
+        def _apply_series(pkgname: str, patchnames: list[str]) -> None:
             sroot = my_root if pkgname == self.root_package.name else dep_root
-            patch = proot / patchname
-            tools.cmd(
-                *(patch_cmd + ["--verbose", "-p1", "-i", str(patch)]),
-                hide_stderr=False,
-                cwd=sroot,
-            )
+            for patchname in patchnames:
+                patch = proot / patchname
+                tools.cmd(
+                    *(patch_cmd + ["--verbose", "-p1", "-i", str(patch)]),
+                    hide_stderr=False,
+                    cwd=sroot,
+                )
+
+        if not series:
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(len(series), os.cpu_count() or 1)
+        ) as pool:
+            futures = [
+                pool.submit(_apply_series, pkgname, patchnames)
+                for pkgname, patchnames in series.items()
+            ]
+            for future in futures:
+                future.result()
 
     def _get_global_env_vars(self) -> dict[str, str]:
         return {}
@@ -239,7 +310,19 @@ class Build(targets.Build):
     def _write_makefile(self) -> None:
         temp_root = self.get_temp_root(relative_to="sourceroot")
         image_root = self.get_image_root(relative_to="sourceroot")
+        bash = self.sh_get_command("bash")
+        build_script = self._write_script("complete", relative_to="sourceroot")
+        install_script = self._write_script(
+            "install", relative_to="sourceroot", installable_only=True
+        )
+        copy_tree = self.sh_get_command("copy-tree", relative_to="sourceroot")
+        env = "\n".join(
+            f"export {var} = {val}"
+            for var, val in self._get_global_env_vars().items()
+        )
 
+        # The template is dedented before substitution, since the
+        # substituted values may span multiple unindented lines.
         makefile = textwrap.dedent(
             """\
             .PHONY: build install
@@ -265,26 +348,16 @@ class Build(targets.Build):
 
         """
         ).format(
-            bash=self.sh_get_command("bash"),
+            bash=bash,
             temp_root=temp_root,
             image_root=image_root,
-            build_script=self._write_script(
-                "complete", relative_to="sourceroot"
-            ),
-            install_script=self._write_script(
-                "install", relative_to="sourceroot", installable_only=True
-            ),
-            copy_tree=self.sh_get_command(
-                "copy-tree", relative_to="sourceroot"
-            ),
-            env="\n".join(
-                f"export {var} = {val}"
-                for var, val in self._get_global_env_vars().items()
-            ),
+            build_script=build_script,
+            install_script=install_script,
+            copy_tree=copy_tree,
+            env=env,
         )
 
-        with open(self._srcroot / "Makefile.metapkg", "w") as f:
-            f.write(makefile)
+        (self._srcroot / "Makefile.metapkg").write_text(makefile)
 
     def _get_package_install_script(self, pkg: packages.BasePackage) -> str:
         source_root = self.get_source_root(relative_to="pkgbuild")
@@ -293,31 +366,18 @@ class Build(targets.Build):
         temp_root = self.get_temp_root(relative_to="sourceroot")
         temp_dir = self.get_temp_dir(pkg, relative_to="sourceroot")
 
-        il_script_text = self._get_package_script(pkg, "install_list")
-        il_script = self.sh_write_bash_helper(
-            f"_gen_install_list_{pkg.unique_name}.sh",
-            il_script_text,
-            relative_to="sourceroot",
-        )
-
-        nil_script_text = self._get_package_script(pkg, "no_install_list")
-        nil_script = self.sh_write_bash_helper(
-            f"_gen_no_install_list_{pkg.unique_name}.sh",
-            nil_script_text,
-            relative_to="sourceroot",
-        )
-
-        ignore_script_text = self._get_package_script(pkg, "ignore_list")
-        ignore_script = self.sh_write_bash_helper(
-            f"_gen_ignore_list_{pkg.unique_name}.sh",
-            ignore_script_text,
-            relative_to="sourceroot",
-        )
-
-        ignored_dep_text = self._get_package_script(pkg, "ignored_dependency")
-        ignored_dep_script = self.sh_write_bash_helper(
-            f"_gen_ignored_deps_{pkg.unique_name}.sh",
-            ignored_dep_text,
+        lists_script = self.sh_write_bash_functions_helper(
+            f"_gen_lists_{pkg.unique_name}.sh",
+            {
+                "install_list": self._get_package_script(pkg, "install_list"),
+                "no_install_list": self._get_package_script(
+                    pkg, "no_install_list"
+                ),
+                "ignore_list": self._get_package_script(pkg, "ignore_list"),
+                "ignored_dependency": self._get_package_script(
+                    pkg, "ignored_dependency"
+                ),
+            },
             relative_to="sourceroot",
         )
 
@@ -341,10 +401,10 @@ class Build(targets.Build):
             f"""
             pushd "{source_root}" >/dev/null
 
-            {il_script} > "{temp_dir}/install"
-            {nil_script} > "{temp_dir}/not-installed"
-            {ignore_script} > "{temp_dir}/ignored"
-            {ignored_dep_script} >> "{temp_root}/ignored-reqs"
+            {lists_script} install_list > "{temp_dir}/install"
+            {lists_script} no_install_list > "{temp_dir}/not-installed"
+            {lists_script} ignore_list > "{temp_dir}/ignored"
+            {lists_script} ignored_dependency >> "{temp_root}/ignored-reqs"
 
             {trim_install} "{temp_dir}/install" \\
                 "{temp_dir}/not-installed" "{temp_dir}/ignored" \\
@@ -354,6 +414,7 @@ class Build(targets.Build):
 
             {copy_tree} \\
                 --verbose \\
+                --link \\
                 --files-from="{temp_dir}/install.list" \\
                 {"--flatten" if flatten else ""} \\
                 "{install_dir}/" "{image_root}/"
@@ -399,25 +460,20 @@ class Build(targets.Build):
         )
 
     def _list_installed_files(self) -> list[pathlib.Path]:
-        image_root = self.get_image_root(relative_to="sourceroot")
-        find = self.sh_get_command("find", relative_to="sourceroot")
-        listing = (
-            tools.cmd(
-                find,
-                image_root,
-                "-type",
-                "f",
-                "-o",
-                "-type",
-                "l",
-                cwd=str(self._srcroot),
-            )
-            .strip()
-            .split("\n")
-        )
-        return [
-            pathlib.Path(entry).relative_to(image_root) for entry in listing
-        ]
+        image_root = self.get_image_root(relative_to="fsroot")
+        files = []
+        dirs = [""]
+        while dirs:
+            reldir = dirs.pop()
+            with os.scandir(image_root / reldir) as it:
+                for entry in it:
+                    relpath = os.path.join(reldir, entry.name)
+                    if entry.is_symlink() or entry.is_file():
+                        files.append(pathlib.Path(relpath))
+                    elif entry.is_dir():
+                        dirs.append(relpath)
+
+        return files
 
     def _fixup_rpath(
         self, image_root: pathlib.Path, binary_relpath: pathlib.Path
@@ -435,26 +491,30 @@ class Build(targets.Build):
         # what's allowed to be linked to on the target system (typically,
         # just the C library).
         image_root = self.get_image_root(relative_to="fsroot")
-        bin_paths: dict[str, set[pathlib.Path]] = collections.defaultdict(set)
-        binaries = set()
+        # Install paths are only ever compared lexically, so they are
+        # kept as plain strings rather than pathlib objects.
+        bin_paths: dict[str, set[str]] = collections.defaultdict(set)
+        binaries: set[str] = set()
         refs = {}
-        root = pathlib.Path("/")
-        symlinks = []
+        symlinks: list[tuple[str, pathlib.Path, str]] = []
         # First, build the list of all binaries and their shlib references.
         for file in files:
             full_path = image_root / file
-            inst_path = root / file
+            inst_path = os.path.join("/", file)
             if full_path.is_symlink():
                 # We'll deal with symlinks separately below.
-                symlinks.append((inst_path, full_path))
+                symlinks.append((inst_path, full_path, os.readlink(full_path)))
                 continue
 
             if self.target.is_binary_code_file(self, full_path):
                 bin_paths[file.name].add(inst_path)
                 binaries.add(inst_path)
+                dynamic = self.target.is_dynamically_linked(self, full_path)
+                if not self.is_debug_build or dynamic:
+                    _unshare_file(full_path)
                 if not self.is_debug_build:
                     self._strip(image_root, file)
-                if self.target.is_dynamically_linked(self, full_path):
+                if dynamic:
                     self._fixup_rpath(image_root, file)
                     refs[inst_path] = self.target.get_shlib_refs(
                         self, image_root, file
@@ -463,29 +523,44 @@ class Build(targets.Build):
         # Now, scan for all symbolic links to binaries
         # (it is common for .so files to be symlinks to their
         # fully-versioned counterparts).
-        for inst_path, full_path in symlinks:
-            target = full_path.readlink()
-            if not target.is_absolute():
-                target = full_path.parent / target
+        for inst_path, _, link_target in symlinks:
+            # Absolute link targets are already install paths.
+            if os.path.isabs(link_target):
+                target_inst_path = link_target
             else:
-                target = image_root / target.relative_to("/")
-            target_inst_path = root / target.relative_to(image_root)
+                target_inst_path = os.path.normpath(
+                    os.path.join(os.path.dirname(inst_path), link_target)
+                )
             if target_inst_path in binaries:
-                bin_paths[inst_path.name].add(inst_path)
+                bin_paths[os.path.basename(inst_path)].add(inst_path)
 
         to_remove: set[pathlib.Path] = set()
         used_shlibs: set[pathlib.Path] = set()
+        unlinked: set[pathlib.Path] = set()
+        # The same handful of system libraries is referenced by nearly
+        # every binary, so remember the verdict for each.
+        allowed_shlibs: dict[pathlib.Path, bool] = {}
 
         # Finally, do the sanity check.
         for binary, (shlibs, rpaths) in refs.items():
             for shlib_path in shlibs:
-                if self.target.is_allowed_system_shlib(self, shlib_path):
+                allowed = allowed_shlibs.get(shlib_path)
+                if allowed is None:
+                    allowed = self.target.is_allowed_system_shlib(
+                        self, shlib_path
+                    )
+                    allowed_shlibs[shlib_path] = allowed
+                if allowed:
                     continue
-                shlib = str(shlib_path.name)
+                shlib = shlib_path.name
                 bundled = bin_paths.get(shlib, set())
                 for rpath in rpaths:
-                    shlib_path = (rpath / shlib).resolve()
-                    if shlib_path in bundled:
+                    # rpaths are locations in the image, not on this
+                    # machine, so only normalize them lexically.
+                    shlib_inst_path = os.path.normpath(
+                        os.path.join(rpath, shlib)
+                    )
+                    if shlib_inst_path in bundled:
                         # Shared libraries are customarily installed as
                         # library.so.<major>.<minor> and then a
                         # library.so and a library.so.<major> symlink is
@@ -497,17 +572,18 @@ class Build(targets.Build):
                         # but, more importantly, acts as a workaround for
                         # systems that are unable to cope with symlinks
                         # in archives (looking at you, Nomad).
-                        full_shlib_path = image_root / shlib_path.relative_to(
-                            root
+                        full_shlib_path = image_root / shlib_inst_path.lstrip(
+                            "/"
                         )
                         used_shlibs.add(full_shlib_path)
                         if full_shlib_path.is_symlink():
                             real_shlib_path = full_shlib_path.readlink()
                             if not real_shlib_path.is_absolute():
-                                real_shlib_path = (
-                                    full_shlib_path.parent / real_shlib_path
-                                ).resolve()
+                                real_shlib_path = _resolve_under(
+                                    full_shlib_path.parent, real_shlib_path
+                                )
                             os.unlink(full_shlib_path)
+                            unlinked.add(full_shlib_path)
                             shutil.copy2(real_shlib_path, full_shlib_path)
                             # Schedule fully-versioned variant for removal.
                             to_remove.add(real_shlib_path)
@@ -527,16 +603,28 @@ class Build(targets.Build):
                             f" not define a library rpath"
                         )
 
+        # Index the remaining symlinks by directory, so that looking for
+        # the ones pointing to a given library doesn't have to rescan
+        # its siblings every time.
+        dir_symlinks: dict[pathlib.Path, dict[pathlib.Path, pathlib.Path]]
+        dir_symlinks = collections.defaultdict(dict)
+        for _, full_path, link_target in symlinks:
+            if full_path in unlinked:
+                continue
+            if os.path.isabs(link_target):
+                resolved = pathlib.Path(link_target)
+            else:
+                resolved = _resolve_under(full_path.parent, link_target)
+            dir_symlinks[full_path.parent][full_path] = resolved
+
         def _remove_so_symlinks(path: pathlib.Path) -> None:
-            for sibling in path.parent.iterdir():
-                if sibling.is_symlink():
-                    sibling_target = sibling.readlink()
-                    if not sibling_target.is_absolute():
-                        sibling_target = (
-                            sibling.parent / sibling_target
-                        ).resolve()
-                    if sibling_target == path:
-                        sibling.unlink()
+            siblings = dir_symlinks.get(path.parent)
+            if not siblings:
+                return
+            for sibling, sibling_target in list(siblings.items()):
+                if sibling_target == path:
+                    sibling.unlink()
+                    del siblings[sibling]
 
         # Remove the fully-versioned .so variants and any symlinks still
         # pointing to it (usually the unversioned .so).
@@ -550,7 +638,6 @@ class Build(targets.Build):
     def _package(self, files: list[pathlib.Path]) -> None:
         pkg = self._root_pkg
 
-        src_root = self.get_source_abspath()
         image_root = self.get_image_root(relative_to="fsroot")
 
         version = packages.pep440_to_semver(pkg.version)
@@ -561,9 +648,11 @@ class Build(targets.Build):
         an = f"{an}-{version}"
         if not pkg.version_includes_revision():
             an = f"{an}_{self._revision}"
-        archives = self.get_intermediate_output_dir()
         archives_abs = self.get_intermediate_output_dir(relative_to="fsroot")
         layout = pkg.get_package_layout(self)
+        # The compression steps are independent of each other, so they
+        # are collected here and run concurrently at the end.
+        jobs: list[Callable[[], object]] = []
 
         if layout is packages.PackageFileLayout.SINGLE_BINARY:
             if len(files) != 1:
@@ -572,19 +661,13 @@ class Build(targets.Build):
                 )
 
             fn = files[0]
-            dest = f"{archives / an}{fn.suffix}"
-            tools.cmd(
-                "cp",
-                image_root / fn,
-                dest,
-                cwd=src_root,
-            )
+            dest = f"{archives_abs / an}{fn.suffix}"
+            shutil.copy(image_root / fn, dest)
 
             mime = self.target.executable_mime_type
 
             installrefs = [
                 f"{an}{fn.suffix}",
-                f"{an}{fn.suffix}.zst",
             ]
 
             installrefs_ct = {
@@ -595,26 +678,18 @@ class Build(targets.Build):
                 },
             }
 
-            installrefs_ct = {
-                f"{an}{fn.suffix}": {
-                    "type": mime,
-                    "encoding": "identity",
-                    "suffix": fn.suffix,
-                },
-                f"{an}{fn.suffix}.zst": {
-                    "type": mime,
-                    "encoding": "zstd",
-                    "suffix": ".zst",
-                },
-            }
-
             if "zstd" in self._compression:
-                tools.cmd(
-                    "zstd",
-                    "--keep",
-                    "-19",
-                    f"{an}{fn.suffix}",
-                    cwd=archives_abs,
+                jobs.append(
+                    functools.partial(
+                        tools.cmd,
+                        "zstd",
+                        "--keep",
+                        "-19",
+                        "-T0",
+                        "--long=27",
+                        f"{an}{fn.suffix}",
+                        cwd=archives_abs,
+                    )
                 )
                 installrefs.append(f"{an}{fn.suffix}.zst")
                 installrefs_ct[f"{an}{fn.suffix}.zst"] = {
@@ -624,12 +699,15 @@ class Build(targets.Build):
                 }
 
             if "gzip" in self._compression:
-                tools.cmd(
-                    "gzip",
-                    "-k",
-                    "-9",
-                    f"{an}{fn.suffix}",
-                    cwd=archives_abs,
+                jobs.append(
+                    functools.partial(
+                        tools.cmd,
+                        "gzip",
+                        "-k",
+                        "-9",
+                        f"{an}{fn.suffix}",
+                        cwd=archives_abs,
+                    )
                 )
                 installrefs.append(f"{an}{fn.suffix}.gz")
                 installrefs_ct[f"{an}{fn.suffix}.gz"] = {
@@ -639,12 +717,15 @@ class Build(targets.Build):
                 }
 
             if "zip" in self._compression:
-                tools.cmd(
-                    "zip",
-                    "-9",
-                    f"{an}{fn.suffix}.zip",
-                    f"{an}{fn.suffix}",
-                    cwd=archives_abs,
+                jobs.append(
+                    functools.partial(
+                        tools.cmd,
+                        "zip",
+                        "-9",
+                        f"{an}{fn.suffix}.zip",
+                        f"{an}{fn.suffix}",
+                        cwd=archives_abs,
+                    )
                 )
                 installrefs.append(f"{an}{fn.suffix}.zip")
                 installrefs_ct[f"{an}{fn.suffix}.zip"] = {
@@ -666,24 +747,14 @@ class Build(targets.Build):
                     src = image_root / prefix
 
                 tarball = f"{an}.tar"
-                tools.cmd(
-                    self.sh_get_command("tar"),
-                    "--transform",
-                    f"flags=r;s|^\\./|{an}/|",
-                    "-c",
-                    "-f",
-                    os.path.relpath(archives_abs / tarball, start=src),
-                    ".",
-                    cwd=src,
-                )
+                compressors: list[tuple[list[str], pathlib.Path]] = []
 
                 if "zstd" in self._compression:
-                    tools.cmd(
-                        "zstd",
-                        "--keep",
-                        "-19",
-                        tarball,
-                        cwd=archives_abs,
+                    compressors.append(
+                        (
+                            ["zstd", "-19", "-T0", "--long=27", "-c"],
+                            archives_abs / f"{tarball}.zst",
+                        )
                     )
                     installrefs.append(f"{tarball}.zst")
                     installrefs_ct[f"{tarball}.zst"] = {
@@ -693,14 +764,9 @@ class Build(targets.Build):
                     }
 
                 if "gzip" in self._compression:
-                    tools.cmd(
-                        "gzip",
-                        "-k",
-                        "-9",
-                        tarball,
-                        cwd=archives_abs,
+                    compressors.append(
+                        (["gzip", "-9", "-c"], archives_abs / f"{tarball}.gz")
                     )
-
                     installrefs.append(f"{tarball}.gz")
                     installrefs_ct[f"{tarball}.gz"] = {
                         "type": "application/x-tar",
@@ -708,7 +774,24 @@ class Build(targets.Build):
                         "suffix": ".tar.gz",
                     }
 
-                (archives_abs / tarball).unlink(missing_ok=True)
+                # Stream the archive straight into the compressors
+                # instead of writing out the uncompressed tarball first.
+                jobs.append(
+                    functools.partial(
+                        tools.pipe,
+                        [
+                            self.sh_get_command("tar"),
+                            "--transform",
+                            f"flags=r;s|^\\./|{an}/|",
+                            "-c",
+                            "-f",
+                            "-",
+                            ".",
+                        ],
+                        compressors,
+                        cwd=src,
+                    )
+                )
 
             if "zip" in self._compression:
                 if layout is packages.PackageFileLayout.FLAT:
@@ -721,13 +804,16 @@ class Build(targets.Build):
                     )
                     srcdir = an
 
-                tools.cmd(
-                    "zip",
-                    "-9",
-                    "-r",
-                    archives_abs / f"{an}.zip",
-                    srcdir,
-                    cwd=image_root,
+                jobs.append(
+                    functools.partial(
+                        tools.cmd,
+                        "zip",
+                        "-9",
+                        "-r",
+                        archives_abs / f"{an}.zip",
+                        srcdir,
+                        cwd=image_root,
+                    )
                 )
 
                 installrefs.append(f"{an}.zip")
@@ -737,6 +823,11 @@ class Build(targets.Build):
                     "suffix": ".zip",
                 }
 
+        if jobs:
+            with concurrent.futures.ThreadPoolExecutor(len(jobs)) as pool:
+                for future in [pool.submit(job) for job in jobs]:
+                    future.result()
+
         with open(archives_abs / "build-metadata.json", "w") as vf:
             json.dump(
                 {
@@ -1,7 +1,8 @@
 from __future__ import annotations
 
+import concurrent.futures
 import datetime
-import glob
+import itertools
 import json
 import os
 import pathlib
@@ -18,6 +19,137 @@ from metapkg import targets
 from metapkg import tools
 
 
+# Locations that are a fixed number of levels below the source root.
+_LOCATION_PREFIXES: dict[str, pathlib.Path] = {
+    "buildroot": pathlib.Path(".."),
+    "pkgsource": pathlib.Path("..", ".."),
+    "pkgbuild": pathlib.Path("..", ".."),
+    "helpers": pathlib.Path("..", ".."),
+}
+
+# Maps extra system requirement categories to RPM scriptlet names.
+_SCRIPTLET_CATEGORIES = {
+    "before-install": "pre",
+    "after-install": "post",
+    "before-uninstall": "preun",
+    "after-uninstall": "postun",
+}
+
+# tar decompression flags by tarball suffix.
+_TAR_COMPFLAGS = {
+    ".bz2": "j",
+    ".gz": "z",
+    ".xz": "J",
+    ".tar": "",
+}
+
+_UNPACK_SCRIPT = textwrap.dedent(
+    """
+    pushd "{src_dir}" >/dev/null
+    /usr/bin/tar -x{compflag} -f {tarball} --strip-components=1
+    popd >/dev/null
+"""
+)
+
+_COMMON_PKG_SPEC = textwrap.dedent(
+    """\
+    %package -n {name}-common
+    Summary: Support files for {title}.
+    Group: {group}
+    License: {license}
+    URL: {url}
+
+    %description -n {name}-common
+    {long_description}
+
+    %files -n {name}-common
+    {common_files}
+"""
+)
+
+_META_PKG_SPEC = textwrap.dedent(
+    """\
+    %package -n {name}
+    Summary: {description}
+    Group: {group}
+    License: {license}
+    URL: {url}
+    {dependencies}
+
+    %description -n {name}
+    {description}
+
+    %files -n {name}
+"""
+)
+
+_SPEC_TEMPLATE = textwrap.dedent(
+    """\
+    Name: {name}
+    Version: {version}
+    Release: {revision}{subdist}%{{?dist}}
+    Summary: {description}
+    License: {license}
+    URL: {url}
+    Group: {group}
+
+    BuildRequires: bash
+    {build_reqs}
+    {runtime_reqs}
+    {conflicts}
+    {provides}
+
+    {source_spec}
+    {patch_spec}
+
+    %description
+    {long_description}
+
+    {common_pkg}
+
+    {meta_pkgs}
+
+    %global __provides_exclude ^.*\\.so(\\..*)?$
+    %global __requires_exclude {requires_exclude}
+
+    %define __python python3
+    %define __brp_mangle_shebangs %{{nil}}
+
+    {debug_pkg}
+
+    %prep
+    {unpack_script}
+    {patch_script}
+
+    %build
+    {build_script}
+
+    %install
+    {install_script}
+    {install_extras}
+
+    %pre
+    {pre_script}
+
+    %post
+    {post_script}
+
+    %files -f {temp_root}/install.list
+    {files_extras}
+
+    %changelog
+    {changelog}
+"""
+)
+
+_CHANGELOG_TEMPLATE = textwrap.dedent(
+    """\
+    * {date} {maintainer} {version}
+    - {metadata}
+"""
+)
+
+
 class Build(targets.Build):
     _target: targets.LinuxDistroTarget
 
@@ -32,6 +164,7 @@ class Build(targets.Build):
         self._tmproot = pathlib.Path("TEMP")
         self._installroot = pathlib.Path("INSTALL")
         self._bin_shims = self._root_pkg.get_bin_shims(self)
+        self._rpmlint: concurrent.futures.Future[str] | None = None
 
     def get_source_abspath(self) -> pathlib.Path:
         return self._srcroot
@@ -60,16 +193,11 @@ class Build(targets.Build):
             Path relative to the specified location.
         """
 
-        if relative_to == "sourceroot":
+        prefix = _LOCATION_PREFIXES.get(relative_to)
+        if prefix is not None:
+            return prefix / path
+        elif relative_to == "sourceroot":
             return pathlib.Path(path)
-        elif relative_to == "buildroot":
-            return pathlib.Path("..") / path
-        elif relative_to == "pkgsource":
-            return pathlib.Path("..") / ".." / path
-        elif relative_to == "pkgbuild":
-            return pathlib.Path("..") / ".." / path
-        elif relative_to == "helpers":
-            return pathlib.Path("..") / ".." / path
         elif relative_to == "fsroot":
             return (self.get_source_abspath() / path).resolve()
         else:
@@ -172,10 +300,28 @@ class Build(targets.Build):
             relative_to_package=relative_to_package,
         )
 
+    def get_tool_list(self) -> list[str]:
+        tools = super().get_tool_list()
+        tools.append("rpm-file-list.py")
+        return tools
+
     def _get_tarball_tpl(self, package: mpkg.BasePackage) -> str:
         rp = self._root_pkg
         return f"{rp.name}_{rp.version.text}.orig-{package.name}{{part}}.tar{{comp}}"
 
+    def run(self) -> None:
+        try:
+            super().run()
+        except BaseException:
+            # Don't leave rpmlint behind if a step before package()
+            # fails, but report that failure rather than rpmlint's.
+            rpmlint, self._rpmlint = self._rpmlint, None
+            if rpmlint is not None:
+                concurrent.futures.wait([rpmlint])
+            raise
+        else:
+            self._wait_for_rpmlint()
+
     def build(self) -> None:
         self.prepare_tools()
         self.prepare_tarballs()
@@ -193,21 +339,7 @@ class Build(targets.Build):
         name = self._root_pkg.name_slot
 
         if self._bin_shims:
-            common_package = textwrap.dedent(
-                """\
-                %package -n {name}-common
-                Summary: Support files for {title}.
-                Group: {group}
-                License: {license}
-                URL: {url}
-
-                %description -n {name}-common
-                {long_description}
-
-                %files -n {name}-common
-                {common_files}
-            """
-            ).format(
+            common_package = _COMMON_PKG_SPEC.format(
                 name=base_name,
                 title=self._root_pkg.title,
                 long_description=self._root_pkg.description,
@@ -225,21 +357,7 @@ class Build(targets.Build):
         meta_pkgs = self._root_pkg.get_meta_packages(self, root_version)
         meta_pkg_specs = []
         for meta_pkg in meta_pkgs:
-            meta_pkg_spec = textwrap.dedent(
-                """\
-                %package -n {name}
-                Summary: {description}
-                Group: {group}
-                License: {license}
-                URL: {url}
-                {dependencies}
-
-                %description -n {name}
-                {description}
-
-                %files -n {name}
-            """
-            ).format(
+            meta_pkg_spec = _META_PKG_SPEC.format(
                 name=meta_pkg.name,
                 description=meta_pkg.description,
                 license=self._root_pkg.license,
@@ -258,21 +376,7 @@ class Build(targets.Build):
                 f"transitional package, can be safely removed, use "
                 f"{name} instead"
             )
-            meta_pkg_spec = textwrap.dedent(
-                """\
-                %package -n {name}
-                Summary: {description}
-                Group: {group}
-                License: {license}
-                URL: {url}
-                {dependencies}
-
-                %description -n {name}
-                {description}
-
-                %files -n {name}
-            """
-            ).format(
+            meta_pkg_spec = _META_PKG_SPEC.format(
                 name=transition,
                 license=self._root_pkg.license,
                 url=self._root_pkg.url,
@@ -294,64 +398,7 @@ class Build(targets.Build):
         if privatelibs:
             requires_exclude.append(privatelibs)
 
-        rules = textwrap.dedent(
-            """\
-            Name: {name}
-            Version: {version}
-            Release: {revision}{subdist}%{{?dist}}
-            Summary: {description}
-            License: {license}
-            URL: {url}
-            Group: {group}
-
-            BuildRequires: bash
-            {build_reqs}
-            {runtime_reqs}
-            {conflicts}
-            {provides}
-
-            {source_spec}
-            {patch_spec}
-
-            %description
-            {long_description}
-
-            {common_pkg}
-
-            {meta_pkgs}
-
-            %global __provides_exclude ^.*\\.so(\\..*)?$
-            %global __requires_exclude {requires_exclude}
-
-            %define __python python3
-            %define __brp_mangle_shebangs %{{nil}}
-
-            {debug_pkg}
-
-            %prep
-            {unpack_script}
-            {patch_script}
-
-            %build
-            {build_script}
-
-            %install
-            {install_script}
-            {install_extras}
-
-            %pre
-            {pre_script}
-
-            %post
-            {post_script}
-
-            %files -f {temp_root}/install.list
-            {files_extras}
-
-            %changelog
-            {changelog}
-        """
-        ).format(
+        rules = _SPEC_TEMPLATE.format(
             name=self._root_pkg.name_slot,
             revision=self._revision,
             subdist=self._subdist if self._subdist else "",
@@ -401,12 +448,7 @@ class Build(targets.Build):
 
     def _get_changelog(self) -> str:
         root_v = self._format_version()
-        changelog = textwrap.dedent(
-            """\
-            * {date} {maintainer} {version}
-            - {metadata}
-        """
-        ).format(
+        changelog = _CHANGELOG_TEMPLATE.format(
             maintainer="MagicStack Inc. <hello@magic.io>",
             version=f"{root_v}-{self._revision}",
             date=datetime.datetime.now(datetime.timezone.utc).strftime(
@@ -426,17 +468,11 @@ class Build(targets.Build):
         return "|".join(private_libs)
 
     def _get_build_reqs_spec(self) -> str:
-        lines = []
-
-        deps = (
-            pkg
+        return "\n".join(
+            f"BuildRequires: {pkg.system_name}"
             for pkg in self._build_deps
             if isinstance(pkg, targets.SystemPackage)
         )
-        for pkg in deps:
-            lines.append(f"BuildRequires: {pkg.system_name}")
-
-        return "\n".join(lines)
 
     def _get_runtime_reqs_spec(self, extrareqs: dict[str, set[str]]) -> str:
         lines = []
@@ -451,61 +487,34 @@ class Build(targets.Build):
             root_v = self._format_version()
             lines.append(f"Requires: {self._root_pkg.name}-common >= {root_v}")
 
-        categorymap = {
-            "before-install": "pre",
-            "after-install": "post",
-            "before-uninstall": "preun",
-            "after-uninstall": "postun",
-        }
-
         for cat, reqs in extrareqs.items():
-            cat = categorymap[cat]
+            cat = _SCRIPTLET_CATEGORIES[cat]
             lines.append(f'Requires({cat}): {" ".join(reqs)}')
 
         return "\n".join(lines)
 
     def _get_conflict_spec(self, conflicts: list[str]) -> str:
-        lines = []
-
-        for conflict in conflicts:
-            lines.append(f"Conflicts: {conflict}")
-
-        return "\n".join(lines)
+        return "\n".join(f"Conflicts: {conflict}" for conflict in conflicts)
 
     def _get_provides_spec(self, provides: list[tuple[str, str]]) -> str:
-        lines = []
-
-        for pkg, ver in provides:
-            lines.append(f"Provides: {pkg} = {ver}")
-
-        return "\n".join(lines)
+        return "\n".join(f"Provides: {pkg} = {ver}" for pkg, ver in provides)
 
     def _get_source_spec(self) -> str:
-        lines = []
-
-        i = 0
-        for _, tarballs in enumerate(self._tarballs.values()):
-            for _, tarball in tarballs:
-                lines.append(f"Source{i}: {tarball.name}")
-                i += 1
-
-        return "\n".join(lines)
+        tarballs = itertools.chain.from_iterable(self._tarballs.values())
+        return "\n".join(
+            f"Source{i}: {tarball.name}"
+            for i, (_, tarball) in enumerate(tarballs)
+        )
 
     def _get_patch_spec(self) -> str:
-        lines = []
-
-        for i, (_, patch) in enumerate(self._patches):
-            lines.append(f"Patch{i}: {patch}")
-
-        return "\n".join(lines)
+        return "\n".join(
+            f"Patch{i}: {patch}" for i, (_, patch) in enumerate(self._patches)
+        )
 
     def _get_patch_script(self) -> str:
-        lines = []
-
-        for i, _patch in enumerate(self._patches):
-            lines.append(f"%patch -P {i} -p1")
-
-        return "\n".join(lines)
+        return "\n".join(
+            f"%patch -P {i} -p1" for i in range(len(self._patches))
+        )
 
     def _get_package_unpack_script(self, pkg: mpkg.BasePackage) -> str:
         tarball_root = self.get_tarball_root(relative_to="pkgbuild")
@@ -515,15 +524,8 @@ class Build(targets.Build):
         for src, tarball_path in tarballs:
             tarball = tarball_root / tarball_path
             ext = tarball.suffix
-            if ext == ".bz2":
-                compflag = "j"
-            elif ext == ".gz":
-                compflag = "z"
-            elif ext == ".xz":
-                compflag = "J"
-            elif ext == ".tar":
-                compflag = ""
-            else:
+            compflag = _TAR_COMPFLAGS.get(ext)
+            if compflag is None:
                 raise NotImplementedError(f"tar{ext} files are not supported")
 
             src_dir = self.get_source_dir(pkg, relative_to="pkgbuild")
@@ -531,12 +533,8 @@ class Build(targets.Build):
                 src_dir /= src.path
 
             script.append(
-                textwrap.dedent(
-                    f"""
-                pushd "{src_dir}" >/dev/null
-                /usr/bin/tar -x{compflag} -f {tarball} --strip-components=1
-                popd >/dev/null
-            """
+                _UNPACK_SCRIPT.format(
+                    src_dir=src_dir, compflag=compflag, tarball=tarball
                 )
             )
 
@@ -549,46 +547,36 @@ class Build(targets.Build):
         temp_root = self.get_temp_root(relative_to="sourceroot")
         temp_dir = self.get_temp_dir(pkg, relative_to="sourceroot")
 
-        il_script_text = self._get_package_script(pkg, "install_list")
-        il_script = self.sh_write_bash_helper(
-            f"_gen_install_list_{pkg.unique_name}.sh",
-            il_script_text,
-            relative_to="sourceroot",
-        )
-
-        nil_script_text = self._get_package_script(pkg, "no_install_list")
-        nil_script = self.sh_write_bash_helper(
-            f"_gen_no_install_list_{pkg.unique_name}.sh",
-            nil_script_text,
-            relative_to="sourceroot",
-        )
-
-        ignore_script_text = self._get_package_script(pkg, "ignore_list")
-        ignore_script = self.sh_write_bash_helper(
-            f"_gen_ignore_list_{pkg.unique_name}.sh",
-            ignore_script_text,
-            relative_to="sourceroot",
-        )
-
-        ignored_dep_text = self._get_package_script(pkg, "ignored_dependency")
-        ignored_dep_script = self.sh_write_bash_helper(
-            f"_gen_ignored_deps_{pkg.unique_name}.sh",
-            ignored_dep_text,
+        lists_script = self.sh_write_bash_functions_helper(
+            f"_gen_lists_{pkg.unique_name}.sh",
+            {
+                "install_list": self._get_package_script(pkg, "install_list"),
+                "no_install_list": self._get_package_script(
+                    pkg, "no_install_list"
+                ),
+                "ignore_list": self._get_package_script(pkg, "ignore_list"),
+                "ignored_dependency": self._get_package_script(
+                    pkg, "ignored_dependency"
+                ),
+            },
             relative_to="sourceroot",
         )
         trim_install = self.sh_get_command(
             "trim-install", relative_to="sourceroot"
         )
         copy_tree = self.sh_get_command("copy-tree", relative_to="sourceroot")
+        rpm_file_list = self.sh_get_command(
+            "rpm-file-list", relative_to="sourceroot"
+        )
 
         return textwrap.dedent(
             f"""
             pushd "{source_root}" >/dev/null
 
-            {il_script} > "{temp_dir}/install"
-            {nil_script} > "{temp_dir}/not-installed"
-            {ignore_script} > "{temp_dir}/ignored"
-            {ignored_dep_script} >> "{temp_root}/ignored-reqs"
+            {lists_script} install_list > "{temp_dir}/install"
+            {lists_script} no_install_list > "{temp_dir}/not-installed"
+            {lists_script} ignore_list > "{temp_dir}/ignored"
+            {lists_script} ignored_dependency >> "{temp_root}/ignored-reqs"
 
             {trim_install} "{temp_dir}/install" \\
                 "{temp_dir}/not-installed" "{temp_dir}/ignored" \\
@@ -596,13 +584,8 @@ class Build(targets.Build):
 
             {copy_tree} -v "{install_dir}/" "{image_root}/"
 
-            while IFS= read -r path; do
-                if [ -d "{install_dir}/${{path}}" ]; then
-                    echo %dir \\"/${{path}}\\" >> "{temp_root}/install.list"
-                else
-                    echo \\"/${{path}}\\" >> "{temp_root}/install.list"
-                fi
-            done < <(cat "{temp_dir}/install.final")
+            {rpm_file_list} "{temp_dir}/install.final" "{install_dir}" \\
+                >> "{temp_root}/install.list"
 
             popd >/dev/null
         """
@@ -614,11 +597,19 @@ class Build(targets.Build):
 
         extras_dir = self.get_extras_root(relative_to="fsroot")
         extras_dir_rel = self.get_extras_root(relative_to="buildroot")
+        # Many extras share their parent directories.
+        created_dirs: set[pathlib.Path] = set()
+
+        def _ensure_dir(directory: pathlib.Path) -> None:
+            if directory not in created_dirs:
+                directory.mkdir(parents=True, exist_ok=True)
+                created_dirs.add(directory)
+                created_dirs.update(directory.parents)
 
         for pkg in self._installable:
             for path, content in pkg.get_service_scripts(self).items():
                 directory = extras_dir / path.parent.relative_to("/")
-                directory.mkdir(parents=True)
+                _ensure_dir(directory)
                 with open(directory / path.name, "w") as f:
                     print(content, file=f)
 
@@ -636,21 +627,26 @@ class Build(targets.Build):
 
         if self._bin_shims:
             sysbindir = self.get_bundle_install_path("systembin")
+            shim_mode = (
+                stat.S_IRWXU
+                | stat.S_IRGRP
+                | stat.S_IXGRP
+                | stat.S_IROTH
+                | stat.S_IXOTH
+            )
 
             for shim_path, data in self._bin_shims.items():
                 relpath = (sysbindir / shim_path).relative_to("/")
                 inst_path = extras_dir / relpath
-                inst_path.parent.mkdir(parents=True, exist_ok=True)
-                with open(inst_path, "w") as f:
-                    f.write(data)
-                os.chmod(
-                    inst_path,
-                    stat.S_IRWXU
-                    | stat.S_IRGRP
-                    | stat.S_IXGRP
-                    | stat.S_IROTH
-                    | stat.S_IXOTH,
+                _ensure_dir(inst_path.parent)
+                fd = os.open(
+                    inst_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, shim_mode
                 )
+                with open(fd, "w") as f:
+                    f.write(data)
+                    # The creation mode is subject to umask and does not
+                    # apply to an existing file.
+                    os.chmod(fd, shim_mode)
 
                 src_path = extras_dir_rel / relpath
                 broot_path = f"%{{_bindir}}/{shim_path}"
@@ -666,14 +662,11 @@ class Build(targets.Build):
         return "\n".join(lines)
 
     def _get_files_extras(self) -> str:
-        lines = []
-
-        for pkg in self._installable:
-            for cmd in pkg.get_exposed_commands(self):
-                cmdname = f"{cmd.name}{pkg.slot_suffix}"
-                lines.append(f"%{{_bindir}}/{cmdname}")
-
-        return "\n".join(lines)
+        return "\n".join(
+            f"%{{_bindir}}/{cmd.name}{pkg.slot_suffix}"
+            for pkg in self._installable
+            for cmd in pkg.get_exposed_commands(self)
+        )
 
     def _get_common_files(self) -> str:
         if self._bin_shims:
@@ -709,7 +702,13 @@ class Build(targets.Build):
             stderr=subprocess.STDOUT,
         )
 
-        tools.cmd(
+        # Linting the spec doesn't affect the produced packages, so let
+        # it run in the meantime; package() waits for it before putting
+        # anything in the output directory, and still fails the build
+        # if it does.
+        pool = concurrent.futures.ThreadPoolExecutor(1)
+        self._rpmlint = pool.submit(
+            tools.cmd,
             "rpmlint",
             "-i",
             f"{self._root_pkg.name_slot}.spec",
@@ -717,6 +716,12 @@ class Build(targets.Build):
             stdout=self.stream,
             stderr=subprocess.STDOUT,
         )
+        pool.shutdown(wait=False)
+
+    def _wait_for_rpmlint(self) -> None:
+        rpmlint, self._rpmlint = self._rpmlint, None
+        if rpmlint is not None:
+            rpmlint.result()
 
     def package(self) -> None:
         archives = self.get_intermediate_output_dir(relative_to="fsroot")
@@ -724,20 +729,32 @@ class Build(targets.Build):
         contents = {}
 
         rpms = self.get_dir("RPMS", relative_to="fsroot") / platform.machine()
-        for rpm_path in glob.glob(str(rpms / "*.rpm")):
-            rpm = pathlib.Path(rpm_path)
-            shutil.copy2(rpm, archives / rpm.name)
-            contents[rpm.name] = {
-                "type": "application/x-rpm",
-                "encoding": "identity",
-                "suffix": ".rpm",
-            }
-
         srpms = self.get_dir("SRPMS", relative_to="fsroot")
-        for rpm_path in glob.glob(str(srpms / "*.rpm")):
-            rpm = pathlib.Path(rpm_path)
-            shutil.copy2(rpm, archives / rpm.name)
-            contents[rpm.name] = {
+        entries: list[os.DirEntry[str]] = []
+        for rpmdir in (rpms, srpms):
+            try:
+                with os.scandir(rpmdir) as it:
+                    # Same selection as a "*.rpm" glob.
+                    entries.extend(
+                        entry
+                        for entry in it
+                        if entry.name.endswith(".rpm")
+                        and not entry.name.startswith(".")
+                    )
+            except FileNotFoundError:
+                continue
+
+        # A lint failure must leave nothing in the output directory.
+        self._wait_for_rpmlint()
+
+        for entry in entries:
+            # The work directory normally holds both trees, so the
+            # usually large packages can just be linked over.
+            try:
+                os.link(entry.path, archives / entry.name)
+            except OSError:
+                shutil.copy2(entry.path, archives / entry.name)
+            contents[entry.name] = {
                 "type": "application/x-rpm",
                 "encoding": "identity",
                 "suffix": ".rpm",
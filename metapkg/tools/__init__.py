@@ -1,9 +1,11 @@
 from . import git
 from .cmd import cmd
+from .cmd import pipe
 from .template import format_template
 
 __all__ = (
     "cmd",
+    "pipe",
     "git",
     "format_template",
 )
@@ -1,8 +1,11 @@
 from __future__ import annotations
-from typing import Any
+from typing import Any, Sequence
 
+import functools
 import logging
 import os
+import pathlib
+import shutil
 import subprocess
 import sys
 
@@ -12,6 +15,23 @@ from metapkg.exceptions import MetapkgRuntimeError
 logger = logging.getLogger(__name__)
 
 
+@functools.lru_cache(maxsize=None)
+def _which(program: str, path: str | None) -> str | None:
+    return shutil.which(program, path=path)
+
+
+def _resolve_executable(program: str, env: Any) -> str:
+    # Bare command names are otherwise looked up by trying to exec
+    # every $PATH entry in turn, on every single invocation.
+    if os.sep in program or (os.altsep and os.altsep in program):
+        return program
+    path = (env if env is not None else os.environ).get("PATH")
+    resolved = _which(program, path)
+    if resolved is None or not os.path.isabs(resolved):
+        return program
+    return resolved
+
+
 def cmd(
     *cmd: str | os.PathLike[str],
     errors_are_fatal: bool = True,
@@ -32,7 +52,12 @@ def cmd(
     print(f"{cwd}> {cmd_line}", file=sys.stderr)
 
     try:
-        p = subprocess.run(str_cmd, text=True, check=True, **default_kwargs)
+        p = subprocess.run(
+            [_resolve_executable(str_cmd[0], kwargs.get("env")), *str_cmd[1:]],
+            text=True,
+            check=True,
+            **default_kwargs,
+        )
     except subprocess.CalledProcessError as e:
         if errors_are_fatal:
             raise MetapkgRuntimeError.create(
@@ -46,3 +71,93 @@ def cmd(
         if output is not None:
             output = output.rstrip()
         return output  # type: ignore
+
+
+def pipe(
+    producer: Sequence[str | os.PathLike[str]],
+    consumers: Sequence[
+        tuple[Sequence[str | os.PathLike[str]], str | os.PathLike[str]]
+    ],
+    *,
+    cwd: str | os.PathLike[str] | None = None,
+    error_context: str | None = None,
+) -> None:
+    """Run *producer* and stream its output into each of *consumers*.
+
+    Each consumer is a ``(command, output_file)`` pair, with
+    *output_file* relative to *cwd*.  This avoids writing the producer
+    output to disk only to have every consumer read it back.
+    """
+    str_producer = [str(c) for c in producer]
+    str_consumers = [
+        ([str(c) for c in cmd], output) for cmd, output in consumers
+    ]
+    sinks_line = ", ".join(
+        f"{' '.join(cmd)} > {output}" for cmd, output in str_consumers
+    )
+    if len(str_consumers) > 1:
+        sinks_line = f"tee({sinks_line})"
+    print(
+        f"{cwd or os.getcwd()}> {' '.join(str_producer)} | {sinks_line}",
+        file=sys.stderr,
+    )
+
+    procs: list[tuple[list[str], subprocess.Popen[bytes]]] = []
+    sinks = []
+
+    def _spawn(cmd: list[str], **kwargs: Any) -> subprocess.Popen[bytes]:
+        proc = subprocess.Popen(cmd, cwd=cwd, stderr=sys.stderr, **kwargs)
+        procs.append((cmd, proc))
+        return proc
+
+    try:
+        producer_proc = _spawn(str_producer, stdout=subprocess.PIPE)
+        assert producer_proc.stdout is not None
+
+        if len(str_consumers) == 1:
+            # A single consumer can read from the producer directly.
+            cmd, output = str_consumers[0]
+            with open(pathlib.Path(cwd or ".") / output, "wb") as f:
+                _spawn(cmd, stdin=producer_proc.stdout, stdout=f)
+            producer_proc.stdout.close()
+        else:
+            for cmd, output in str_consumers:
+                with open(pathlib.Path(cwd or ".") / output, "wb") as f:
+                    proc = _spawn(cmd, stdin=subprocess.PIPE, stdout=f)
+                assert proc.stdin is not None
+                sinks.append(proc.stdin)
+
+            # A consumer that exits early is just not written to any
+            # more, its exit code is reported below.
+            live_sinks = list(sinks)
+            with producer_proc.stdout:
+                while live_sinks and (
+                    chunk := producer_proc.stdout.read(1 << 20)
+                ):
+                    for sink in list(live_sinks):
+                        try:
+                            sink.write(chunk)
+                        except BrokenPipeError:
+                            live_sinks.remove(sink)
+
+            for sink in sinks:
+                try:
+                    sink.close()
+                except BrokenPipeError:
+                    pass
+    except BaseException:
+        for _, proc in procs:
+            proc.kill()
+        raise
+    finally:
+        for _, proc in procs:
+            proc.wait()
+
+    # Check the consumers first: if one of them failed, the producer
+    # may have only failed because nothing was reading its output.
+    for cmd, proc in procs[1:] + procs[:1]:
+        if proc.returncode != 0:
+            raise MetapkgRuntimeError.create(
+                reason=error_context or f"{cmd[0]} failed",
+                exception=subprocess.CalledProcessError(proc.returncode, cmd),
+            )
@@ -3,12 +3,21 @@ from typing import (
     Any,
     Callable,
     Collection,
+    Iterator,
+    cast,
     overload,
 )
 
+import contextlib
+import functools
+import os
 import pathlib
 import subprocess
+import threading
 
+from dulwich import objects as dulwich_objects
+from dulwich import objectspec as dulwich_objectspec
+from dulwich import repo as dulwich_repo
 from poetry.core.vcs import git as core_git
 from poetry.utils import helpers as poetry_helpers
 from poetry.vcs.git import backend as poetry_git
@@ -18,12 +27,44 @@ from metapkg import exceptions
 from .cmd import cmd
 
 
+def _get_jobs() -> int:
+    # Submodule clones are bound by network latency rather than CPU,
+    # but there is little to gain from a very large number of them.
+    return min(8, os.cpu_count() or 4)
+
+
+@functools.lru_cache(maxsize=None)
+def _source_root() -> pathlib.Path:
+    # This loads the poetry configuration from disk every time.
+    return poetry_git.Git.get_default_source_root()
+
+
+@functools.lru_cache(maxsize=None)
 def repodir(repo_url: str) -> pathlib.Path:
-    source_root = poetry_git.Git.get_default_source_root()
+    source_root = _source_root()
     name = poetry_git.Git.get_name_from_source_url(url=repo_url)
     return source_root / name
 
 
+# Remote refs and the remote HEAD target, by repository URL.  These
+# are listed once per process, however many times a repo is updated.
+_remote_state_cache: dict[str, tuple[dict[str, str], str]] = {}
+
+
+# Repositories may be cloned from several threads at once, but each
+# checkout directory must only be touched by one of them at a time.
+_repo_dir_locks: dict[pathlib.Path, threading.Lock] = {}
+_repo_dir_locks_lock = threading.Lock()
+
+
+def _get_repo_dir_lock(repo_dir: pathlib.Path) -> threading.Lock:
+    with _repo_dir_locks_lock:
+        lock = _repo_dir_locks.get(repo_dir)
+        if lock is None:
+            lock = _repo_dir_locks[repo_dir] = threading.Lock()
+        return lock
+
+
 class GitError(Exception):
     pass
 
@@ -38,6 +79,7 @@ class Git(core_git.Git):
             raise GitError(f"git: could not initialize: {e}") from e
 
         self._work_dir = work_dir
+        self._work_dir_exists = False
 
     @property
     def head(self) -> str:
@@ -61,7 +103,7 @@ class Git(core_git.Git):
         error_context: str | None = None,
         **kwargs: Any,
     ) -> str:
-        if not folder and self._work_dir and self._work_dir.exists():
+        if not folder and self._work_dir and self._check_work_dir():
             folder = self._work_dir
         return cmd(
             "git",
@@ -71,6 +113,13 @@ class Git(core_git.Git):
             **kwargs,
         ).strip(" \n\t")
 
+    def _check_work_dir(self) -> bool:
+        # Work directories are not expected to go away once they exist,
+        # so don't stat them again for every git command.
+        if not self._work_dir_exists:
+            self._work_dir_exists = self._work_dir.exists()
+        return self._work_dir_exists
+
     @overload
     def run_or(
         self,
@@ -178,23 +227,55 @@ class Git(core_git.Git):
         assert work_tree is not None
         return work_tree
 
+    @contextlib.contextmanager
+    def open_dulwich_repo(self) -> Iterator[dulwich_repo.Repo]:
+        repo = dulwich_repo.Repo(str(self._work_dir))
+        try:
+            yield repo
+        finally:
+            repo.close()
+
     def resolve_local_rev(self, rev: str) -> str | None:
         """Resolve a local revision spec to a full commit SHA.
 
         If the *refspec* cannot be resolved, return None.
         """
-        sha = self.run_or(
-            "rev-parse",
-            "--verify",
-            "--quiet",
-            "--end-of-options",
-            f"{rev}^{{commit}}",
-        )
+        try:
+            sha = self._resolve_local_ref(rev)
+        except Exception:
+            sha = None
+
+        if sha is None:
+            sha = self.run_or(
+                "rev-parse",
+                "--verify",
+                "--quiet",
+                "--end-of-options",
+                f"{rev}^{{commit}}",
+            )
         if sha is not None and not poetry_git.is_revision_sha(sha):
             # rev-parse returned *something* but it isn't a SHA
             sha = None
         return sha
 
+    def _resolve_local_ref(self, rev: str) -> str | None:
+        # Full SHAs and ref names, which is what we get asked about,
+        # are looked up in-process.  Anything else (short SHAs,
+        # revision expressions) is left to git rev-parse.
+        with self.open_dulwich_repo() as repo:
+            if poetry_git.is_revision_sha(rev):
+                sha = rev.encode()
+            else:
+                sha = repo.refs[dulwich_objectspec.parse_ref(repo, rev)]
+            obj = repo[sha]
+            while isinstance(obj, dulwich_objects.Tag):
+                obj = repo[obj.object[1]]
+        if isinstance(obj, dulwich_objects.Commit):
+            commit_sha: str = obj.id.decode()
+            return commit_sha
+        else:
+            return None
+
 
 class GitClone(Git):
     @classmethod
@@ -229,17 +310,44 @@ class GitClone(Git):
 
     def __init__(self, repo_url: str, work_dir: pathlib.Path) -> None:
         super().__init__(work_dir)
-        self._remote_refs: dict[str, str] = {}
-        self.run_or(
-            "remote",
-            "set-url",
-            "origin",
-            repo_url,
-            when_exit_code=2,
-            default=lambda _: self.run("remote", "add", repo_url),
-        )
+        self._repo_url = repo_url
+        if self._get_origin_url() != repo_url:
+            self.run_or(
+                "remote",
+                "set-url",
+                "origin",
+                repo_url,
+                when_exit_code=2,
+                default=lambda _: self.run("remote", "add", repo_url),
+            )
+
+    def _get_origin_url(self) -> str | None:
+        try:
+            with self.open_dulwich_repo() as repo:
+                config = repo.get_config()
+                url: bytes = config.get((b"remote", b"origin"), b"url")
+            return url.decode()
+        except Exception:
+            return None
 
     def resolve_remote_symref(self, ref: str) -> str:
+        if ref == "HEAD":
+            target = self._get_remote_state()[1]
+        else:
+            target = self._ls_remote_symref(ref)
+
+        if not target:
+            raise exceptions.MetapkgRuntimeError.create(
+                f"could not resolve remote {ref} symbolic ref",
+                info=[
+                    f"git ls-remote --symref origin {ref} did not produce "
+                    "useful output",
+                ],
+            )
+
+        return target
+
+    def _ls_remote_symref(self, ref: str) -> str:
         output = self.run(
             "ls-remote",
             "--exit-code",
@@ -249,56 +357,55 @@ class GitClone(Git):
             ref,
             error_context=f"could not resolve remote {ref} symbolic ref",
         )
-        target = ""
         for line in output.splitlines():
             line = line.strip()
             if not line:
                 continue
             line_oid, _, line_ref = line.partition("\t")
             if line_ref == ref and line_oid.startswith("ref:"):
-                target = line_oid.removeprefix("ref:").strip()
-                break
+                return line_oid.removeprefix("ref:").strip()
 
-        if not target:
-            raise exceptions.MetapkgRuntimeError.create(
-                f"could not resolve remote {ref} symbolic ref",
-                info=[
-                    f"git ls-remote --symref origin {ref} did not produce "
-                    "useful output",
-                ],
-            )
-
-        return target
+        return ""
 
-    def _fetch_remote_refs(self) -> dict[str, str]:
+    def _fetch_remote_refs(self) -> tuple[dict[str, str], str]:
+        # List the refs and what HEAD points to in one round trip.
+        # Without --refs the output also has peeled tags and HEAD
+        # itself, neither of which is a ref we can fetch by name.
         output = self.run(
             "ls-remote",
-            "--refs",
+            "--symref",
             "origin",
+            "HEAD",
             "refs/tags/**",
             "refs/heads/**",
             error_context="could not list remote git refs",
         )
 
-        if not output:
-            return {}
-
         ref_map: dict[str, str] = {}
+        head_target = ""
         for line in output.splitlines():
             line = line.strip()
             if not line:
                 continue
             sha, _, name = line.partition("\t")
-            ref_map[name] = sha
+            if name == "HEAD":
+                if sha.startswith("ref:"):
+                    head_target = sha.removeprefix("ref:").strip()
+            elif not name.endswith("^{}") and not sha.startswith("ref:"):
+                ref_map[name] = sha
+
+        return ref_map, head_target
 
-        return ref_map
+    def _get_remote_state(self) -> tuple[dict[str, str], str]:
+        state = _remote_state_cache.get(self._repo_url)
+        if state is None:
+            state = self._fetch_remote_refs()
+            _remote_state_cache[self._repo_url] = state
+        return state
 
     @property
     def remote_refs(self) -> dict[str, str]:
-        if not self._remote_refs:
-            self._remote_refs = self._fetch_remote_refs()
-
-        return self._remote_refs
+        return self._get_remote_state()[0]
 
     def normalize_remote_ref(self, ref: str) -> str | None:
         if ref == "HEAD":
@@ -307,6 +414,19 @@ class GitClone(Git):
         tag_ref = f"refs/tags/{ref}"
         peeled_tag_ref = f"{tag_ref}^{{}}"
         branch_ref = f"refs/heads/{ref}"
+
+        # Tags and branches fetched before can be told apart without
+        # asking the remote.  SHAs are always looked up remotely, as
+        # a stale local ref pointing to one might be gone upstream.
+        try:
+            with self.open_dulwich_repo() as repo:
+                if tag_ref.encode() in repo.refs:
+                    return tag_ref
+                elif f"refs/remotes/origin/{ref}".encode() in repo.refs:
+                    return branch_ref
+        except Exception:
+            pass
+
         remote_refs = self.remote_refs
 
         if tag_ref in remote_refs or peeled_tag_ref in remote_refs:
@@ -317,9 +437,11 @@ class GitClone(Git):
             return branch_ref
         else:
             # It's a SHA or maybe a refspec, loop through remote refs
-            # to find if any ref points to it.
+            # to find if any ref points to it.  _fetch_remote_refs()
+            # only keeps lines with an object name, so every value
+            # here is a full SHA already.
             for name, rev in remote_refs.items():
-                if poetry_git.is_revision_sha(rev) and rev.startswith(ref):
+                if rev.startswith(ref):
                     return name
             else:
                 # No remote ref points to the requested revision,
@@ -341,13 +463,7 @@ class GitClone(Git):
             fetch_depth = None
         else:
             fetch_depth = clone_depth
-        # Reset the index.
-        self.run("reset", "--hard")
-        # Fetch new stuff.
-        args = ["--quiet", "--prune", "--prune-tags", "--tags"]
-        if fetch_depth:
-            args.append(f"--depth={fetch_depth}")
-        self.run("fetch", *args, "origin", refspec)
+
         if refspec.startswith("refs/tags/"):
             # Avoid creating ambiguous local refs when updating to a tag.
             branch = f"{pathlib.Path(refspec).name}-branch"
@@ -357,20 +473,82 @@ class GitClone(Git):
             # Detached HEAD
             branch = None
 
-        args = ["--quiet"]
-        if branch is not None:
-            args.extend(["-B", branch])
-        else:
-            args.append("--detach")
-        args.append("FETCH_HEAD" if refspec else remote_ref)
+        # Reset the index.
+        self.run("reset", "--hard")
+
+        if not self._is_checked_out(refspec, remote_ref, branch):
+            # Fetch new stuff.
+            args = ["--quiet", "--prune", "--prune-tags", "--tags"]
+            if fetch_depth:
+                args.append(f"--depth={fetch_depth}")
+            self.run("fetch", *args, "origin", refspec)
+
+            args = ["--quiet"]
+            if branch is not None:
+                args.extend(["-B", branch])
+            else:
+                args.append("--detach")
+            args.append("FETCH_HEAD" if refspec else remote_ref)
 
-        self.run("checkout", *args)
+            self.run("checkout", *args)
 
         self._update_submodules(
             exclude=exclude_submodules,
             clone_depth=clone_depth,
         )
 
+    @staticmethod
+    def _read_ref(repo: dulwich_repo.Repo, name: bytes) -> bytes | None:
+        # dulwich leaves read_ref() unannotated.
+        read_ref = cast(Callable[[bytes], "bytes | None"], repo.refs.read_ref)
+        return read_ref(name)
+
+    def _is_checked_out(
+        self,
+        refspec: str,
+        remote_ref: str,
+        branch: str | None,
+    ) -> bool:
+        """Tell whether the checkout is already where update() would go.
+
+        That is, HEAD is on *branch* (or detached if it is None) and
+        points to the commit that *refspec* (or *remote_ref*, if there
+        is no refspec) has on the remote.
+        """
+        try:
+            with self.open_dulwich_repo() as repo:
+                head_ref = self._read_ref(repo, b"HEAD")
+                if refspec.startswith("refs/tags/"):
+                    local_tag = self._read_ref(repo, refspec.encode())
+                else:
+                    local_tag = None
+
+            if branch is not None:
+                if head_ref != f"ref: refs/heads/{branch}".encode():
+                    return False
+            elif head_ref is None or head_ref.startswith(b"ref: "):
+                return False
+
+            head = self.head
+            if not refspec:
+                return remote_ref == head
+            remote_sha = self.remote_refs.get(refspec)
+            if remote_sha is None:
+                return False
+            elif remote_sha == head:
+                return True
+            elif local_tag is not None:
+                # Annotated tags list the tag object rather than the
+                # commit, so compare with the local copy of the tag.
+                return (
+                    local_tag.decode() == remote_sha
+                    and self.resolve_local_rev(refspec) == head
+                )
+            else:
+                return False
+        except Exception:
+            return False
+
     def _update_submodules(
         self,
         *,
@@ -382,30 +560,41 @@ class GitClone(Git):
         deinit_submodules = set()
 
         if exclude:
+            # Get all submodule paths at once.  With --null, entries
+            # end with NUL and the key ends with a newline, so paths
+            # containing whitespace come through intact.
             output = self.run_or(
                 "config",
                 "--file",
                 ".gitmodules",
-                "--name-only",
+                "--null",
                 "--get-regexp",
-                "path",
+                r"^submodule\..*\.path$",
                 # No .gitmodules file, that's fine
                 when_exit_code=1,
                 default="",
             )
 
             submodules = set()
-            for smc in output.splitlines():
-                submodule_path = self.run(
-                    "config", "--file", ".gitmodules", smc
-                ).strip()
+            for entry in output.split("\0"):
+                _, sep, submodule_path = entry.partition("\n")
+                if not sep:
+                    continue
+                submodule_path = submodule_path.strip()
                 if submodule_path not in exclude:
                     submodules.add(submodule_path)
                 else:
                     deinit_submodules.add(submodule_path)
 
         if submodules != set():
-            args = ("submodule", "update", "--init", "--checkout", "--force")
+            args = (
+                "submodule",
+                "update",
+                "--init",
+                "--checkout",
+                "--force",
+                f"--jobs={_get_jobs()}",
+            )
             if clone_depth:
                 args += (f"--depth={clone_depth}",)
             if submodules:
@@ -426,25 +615,30 @@ def clone_repo(
 ) -> GitClone:
     repo_dir = repodir(repo_url)
 
-    if clean_checkout:
-        poetry_helpers.remove_directory(repo_dir, force=True)
-
-    if repo_dir.exists():
-        try:
-            repo = GitClone(repo_url, repo_dir)
-        except GitError:
-            # Something is up with the current clone, start fresh.
+    with _get_repo_dir_lock(repo_dir):
+        if clean_checkout:
             poetry_helpers.remove_directory(repo_dir, force=True)
+            exists = False
+        else:
+            exists = repo_dir.exists()
+
+        if exists:
+            try:
+                repo = GitClone(repo_url, repo_dir)
+            except GitError:
+                # Something is up with the current clone, start fresh.
+                poetry_helpers.remove_directory(repo_dir, force=True)
+                exists = False
+
+        if not exists:
+            repo = GitClone.initial_clone(
+                repo_url, repo_dir, clone_depth=clone_depth
+            )
 
-    if not repo_dir.exists():
-        repo = GitClone.initial_clone(
-            repo_url, repo_dir, clone_depth=clone_depth
+        repo.update(
+            remote_ref,
+            exclude_submodules=exclude_submodules,
+            clone_depth=clone_depth,
         )
 
-    repo.update(
-        remote_ref,
-        exclude_submodules=exclude_submodules,
-        clone_depth=clone_depth,
-    )
-
     return repo
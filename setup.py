@@ -19,6 +19,7 @@ setup(
     install_requires=[
         "build~=1.2.1",
         "distro~=1.9.0",
+        "dulwich~=0.22.6",
         "requests~=2.31.0",
         "poetry~=2.1.3",
         "distlib~=0.3.8",